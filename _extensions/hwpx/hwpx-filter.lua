@@ -36,6 +36,7 @@ local HEADING_CHAR_PROPS = {
 local HEADING_SPACING = { [2]=800, [3]=600, [4]=400 }
 
 local CODE_CHAR_PR_ID = 10
+local CODE_CHAR_PR_ID_STR = tostring(CODE_CHAR_PR_ID)
 local CODE_FONT_REF   = 2
 
 local CAPTION_PARA_PR_ID = 20
@@ -46,12 +47,20 @@ local CHAR_HEIGHT_MAP = {
   [0]=1000, [7]=2200, [8]=1600, [9]=1300, [10]=1000, [11]=CAPTION_CHAR_HEIGHT,
 }
 
+-- Same heights keyed by the string ids the paragraph builders pass around
+local CHAR_HEIGHT_BY_ID = {}
+for id, height in pairs(CHAR_HEIGHT_MAP) do CHAR_HEIGHT_BY_ID[tostring(id)] = height end
+
 local TABLE_BORDER_FILL_ID = 3
 local PAGE_TEXT_WIDTH = 42520
 local CHAR_HEIGHT_NORMAL = 1000
 local LINE_SPACING_PCT = 160
 local LUNIT_PER_MM = 283.465
 
+-- Fixed text-run fragments, built once instead of per run
+local RUN_TEXT_CLOSE = '</hp:t></hp:run>'
+local CODE_RUN_OPEN = '<hp:run charPrIDRef="' .. CODE_CHAR_PR_ID .. '"><hp:t>'
+
 -- Callout styles (5 types with colors for left border + background)
 local CALLOUT_STYLES = {
   note      = {title = '참고',  border_color = '#2780E3', bg_color = '#EBF3FB', border_fill_id = 4},
@@ -61,6 +70,17 @@ local CALLOUT_STYLES = {
   important = {title = '중요',  border_color = '#D63384', bg_color = '#FCEEF5', border_fill_id = 8},
 }
 
+-- Div classes that mark a standard callout: callout-note, callout-warning, ...
+local CALLOUT_CLASSES = {}
+for ctype in pairs(CALLOUT_STYLES) do CALLOUT_CLASSES['callout-' .. ctype] = true end
+
+-- Ideographic-space indent strings for the usual nesting depths (0-15)
+local INDENT_PREFIXES = {}
+for i = 0, 15 do INDENT_PREFIXES[i] = ('\u{3000}'):rep(i) end
+
+-- Horizontal rule text: 30 x '━'
+local HR_TEXT = ('\u{2501}'):rep(30)
+
 -- Bullet markers by nesting depth: ●, ○, ■, ▪
 local BULLET_MARKERS = {'\u{25CF}', '\u{25CB}', '\u{25A0}', '\u{25AA}'}
 
@@ -82,16 +102,24 @@ local ORDERED_FORMATTERS = {
 local para_id_counter = 3121190098
 local max_char_pr_id = CAPTION_CHAR_PR_ID
 local char_pr_cache = {}
+local char_pr_entries = {}  -- char_pr_cache values in id order, for header emission
 local images = {}
 local callout_used_types = {}
-local callout_types_from_source = {}
+local callout_types_from_source = nil  -- scanned lazily, see source_callout_types()
+local callout_source_candidates = {}
 local callout_index = 0
 local code_fold_enabled = false
 local list_depth = 0
+local paragraph_lineseg_cache = {}  -- char_height -> text -> lineseg XML
+local bold_char_pr_id = nil  -- resolved on first use, see get_bold_char_pr_id()
+local image_dimensions = {}  -- resolved image path -> {w, h}, or false when unknown
+local image_counter = 0
+local equation_xml_cache = {}  -- LaTeX source -> equation XML
 
+-- Integer id: every caller concatenates it straight into XML
 local function next_para_id()
   para_id_counter = para_id_counter + 1
-  return tostring(para_id_counter)
+  return para_id_counter
 end
 
 local function unique_id()
@@ -102,10 +130,15 @@ end
 -- PART 3: Utility Functions
 -- ══════════════════════════════════════════════════════════════════════
 
+local XML_ESCAPES = {
+  ['&'] = '&amp;', ['<'] = '&lt;', ['>'] = '&gt;', ['"'] = '&quot;', ["'"] = '&apos;',
+}
+
 local function xml_escape(s)
   if not s then return '' end
-  return s:gsub('&', '&amp;'):gsub('<', '&lt;'):gsub('>', '&gt;')
-           :gsub('"', '&quot;'):gsub("'", '&apos;')
+  -- Most runs are plain words: skip the replacement pass entirely
+  if not s:find('[&<>"\']') then return s end
+  return (s:gsub('[&<>"\']', XML_ESCAPES))
 end
 
 local function file_exists(path)
@@ -115,7 +148,7 @@ local function file_exists(path)
 end
 
 local function read_file(path)
-  local f = io.open(path, 'r')
+  local f = io.open(path, 'rb')
   if not f then return nil end
   local content = f:read('*a')
   f:close()
@@ -123,13 +156,29 @@ local function read_file(path)
 end
 
 local function write_file(path, content)
-  local f = io.open(path, 'w')
+  local f = io.open(path, 'wb')
   if not f then return false end
   f:write(content)
   f:close()
   return true
 end
 
+local function copy_file(src, dest)
+  local content = read_file(src)
+  if not content then return false end
+  return write_file(dest, content)
+end
+
+local function indent_string(level)
+  return INDENT_PREFIXES[level] or ('\u{3000}'):rep(level)
+end
+
+-- Make text safe as a gsub replacement string ('%' is special there)
+local function escape_repl(s)
+  if not s:find('%', 1, true) then return s end
+  return (s:gsub('%%', '%%%%'))
+end
+
 local function shell_escape(s)
   return "'" .. s:gsub("'", "'\\''") .. "'"
 end
@@ -155,41 +204,74 @@ end
 local function get_jpeg_dimensions(path)
   local f = io.open(path, 'rb')
   if not f then return nil, nil end
-  local data = f:read('*a')
-  f:close()
-  local i = 3
-  while i < #data - 8 do
-    if data:byte(i) == 0xFF then
-      local marker = data:byte(i+1)
+  -- Walk segment headers with seek instead of loading the whole file:
+  -- the SOF marker sits near the start, ahead of the entropy-coded data
+  local w, h = nil, nil
+  f:seek('set', 2)
+  while true do
+    local b = f:read(1)
+    if not b then break end
+    if b:byte() == 0xFF then
+      local hdr = f:read(3)
+      if not hdr or #hdr < 3 then break end
+      local marker = hdr:byte(1)
       if marker >= 0xC0 and marker <= 0xCF and marker ~= 0xC4 and marker ~= 0xC8 and marker ~= 0xCC then
-        local h = data:byte(i+5)*256 + data:byte(i+6)
-        local w = data:byte(i+7)*256 + data:byte(i+8)
-        return w, h
+        local sof = f:read(5)
+        if sof and #sof == 5 then
+          h = sof:byte(2)*256 + sof:byte(3)
+          w = sof:byte(4)*256 + sof:byte(5)
+        end
+        break
       end
-      local seg_len = data:byte(i+2)*256 + data:byte(i+3)
-      i = i + 2 + seg_len
-    else
-      i = i + 1
+      local seg_len = hdr:byte(2)*256 + hdr:byte(3)
+      f:seek('cur', seg_len - 2)
     end
   end
-  return nil, nil
+  f:close()
+  return w, h
 end
 
 local function get_image_dimensions(path)
-  if not path or not file_exists(path) then return nil, nil end
-  local lower = path:lower()
-  if lower:match('%.png$') then
-    return get_png_dimensions(path)
-  elseif lower:match('%.jpe?g$') then
-    return get_jpeg_dimensions(path)
+  if not path then return nil, nil end
+  -- Figures are often reused: read each file's header once per conversion
+  local cached = image_dimensions[path]
+  if cached ~= nil then
+    if cached then return cached[1], cached[2] end
+    return nil, nil
+  end
+  local w, h
+  if file_exists(path) then
+    local lower = path:lower()
+    if lower:match('%.png$') then
+      w, h = get_png_dimensions(path)
+    elseif lower:match('%.jpe?g$') then
+      w, h = get_jpeg_dimensions(path)
+    end
   end
-  return nil, nil
+  image_dimensions[path] = (w and h) and {w, h} or false
+  return w, h
 end
 
 -- ══════════════════════════════════════════════════════════════════════
 -- PART 5: Math Converter (LaTeX → HWP Script)
 -- ══════════════════════════════════════════════════════════════════════
 
+-- LaTeX command name → HWP script keyword; any other command keeps its
+-- name without the backslash
+local LATEX_SYMBOLS = {
+  geq = '>=', leq = '<=', neq = '<>',
+  times = 'times', cdot = 'cdot', cdots = 'cdots',
+  ldots = 'ldots', infty = 'inf', pm = '+-',
+  mp = '-+', approx = 'approx', equiv = 'equiv',
+  partial = 'partial', nabla = 'nabla',
+  rightarrow = 'rightarrow', leftarrow = 'leftarrow',
+  Rightarrow = 'Rightarrow', Leftarrow = 'Leftarrow',
+}
+
+local function latex_command(name)
+  return LATEX_SYMBOLS[name] or name
+end
+
 local function latex_to_hwp_script(latex)
   local s = latex:match('^%s*(.-)%s*$')
   s = s:gsub('^%$', ''):gsub('%$$', '')
@@ -197,32 +279,26 @@ local function latex_to_hwp_script(latex)
   s = s:gsub('\\sum_{([^}]*)}%^{([^}]*)}', 'sum from{%1} to{%2}')
   s = s:gsub('\\int_{([^}]*)}%^{([^}]*)}', 'int from{%1} to{%2}')
   s = s:gsub('\\sqrt{([^}]*)}', 'sqrt{%1}')
-  s = s:gsub('\\left%(', 'left('):gsub('\\right%)', 'right)')
-  s = s:gsub('\\left%[', 'left['):gsub('\\right%]', 'right]')
   s = s:gsub('\\left\\{', 'left lbrace '):gsub('\\right\\}', 'right rbrace ')
-  local symbols = {
-    {'\\geq','>='},{'\\leq','<='},{'\\neq','<>'},
-    {'\\times','times'},{'\\cdot','cdot'},{'\\cdots','cdots'},
-    {'\\ldots','ldots'},{'\\infty','inf'},{'\\pm','+-'},
-    {'\\mp','-+'},{'\\approx','approx'},{'\\equiv','equiv'},
-    {'\\partial','partial'},{'\\nabla','nabla'},
-    {'\\rightarrow','rightarrow'},{'\\leftarrow','leftarrow'},
-    {'\\Rightarrow','Rightarrow'},{'\\Leftarrow','Leftarrow'},
-  }
-  for _, pair in ipairs(symbols) do
-    s = s:gsub(pair[1]:gsub('\\', '\\\\'), pair[2])
-  end
-  s = s:gsub('\\([a-zA-Z]+)', '%1')
+  -- One pass over all commands: symbols are looked up, \left( and the
+  -- like simply lose their backslash
+  s = s:gsub('\\([a-zA-Z]+)', latex_command)
   return s
 end
 
+-- Equation markup has no ids, so repeated formulas within a conversion
+-- reuse the first result
 local function make_equation_xml(latex_str)
+  local xml = equation_xml_cache[latex_str]
+  if xml then return xml end
   local script = latex_to_hwp_script(latex_str)
   local safe = xml_escape(script)
-  return '<hp:equation version="eqEdit" baseLine="0"'
+  xml = '<hp:equation version="eqEdit" baseLine="0"'
     .. ' textColor="#000000" baseUnit="1000" lineMode="0" font="">'
     .. '<hp:script>' .. safe .. '</hp:script>'
     .. '</hp:equation>'
+  equation_xml_cache[latex_str] = xml
+  return xml
 end
 
 -- ══════════════════════════════════════════════════════════════════════
@@ -247,35 +323,51 @@ local function compute_lineseg_xml(text, char_height, horzsize)
   end
 
   local line_starts = {0}
-  local current_width = 0
-  local len = utf8.len(text) or #text
-  local i = 0
-  for _, code in utf8.codes(text) do
-    if code > 0x2000 then
-      current_width = current_width + char_height
-    else
-      current_width = current_width + math.floor(char_height / 2)
+  -- Per-character widths are fixed for the paragraph: compute them once
+  local full_width = char_height
+  local half_width = math.floor(char_height / 2)
+  if half_width > 0 and not text:find('[\128-\255]') then
+    -- ASCII only: every character is half width, so each line holds the
+    -- same number of characters and the breaks follow arithmetically
+    local per_line = math.floor(horzsize / half_width) + 1
+    for pos = per_line, #text - 1, per_line do
+      line_starts[#line_starts + 1] = pos
     end
-    i = i + 1
-    if current_width > horzsize and i < len then
-      line_starts[#line_starts + 1] = i
-      current_width = 0
+  else
+    -- A break is only recorded once another character follows it, so
+    -- the text is scanned once without counting its length first
+    local current_width = 0
+    local i = 0
+    local pending
+    for _, code in utf8.codes(text) do
+      if pending then
+        line_starts[#line_starts + 1] = pending
+        pending = nil
+      end
+      if code > 0x2000 then
+        current_width = current_width + full_width
+      else
+        current_width = current_width + half_width
+      end
+      i = i + 1
+      if current_width > horzsize then
+        pending = i
+        current_width = 0
+      end
     end
   end
 
+  -- Everything after vertpos is shared by the paragraph's lines except
+  -- the flags: first line 0x20000, last line 0x40000 (both when single)
   local num_lines = #line_starts
+  local seg_tail = '" vertsize="' .. vertsize .. '" textheight="' .. vertsize .. '"'
+    .. ' baseline="' .. baseline .. '" spacing="' .. spacing .. '"'
+    .. ' horzpos="0" horzsize="' .. horzsize .. '" flags="'
   local parts = {'<hp:linesegarray>'}
   for idx, textpos in ipairs(line_starts) do
-    local vertpos = (idx - 1) * line_height
-    local flags
-    if num_lines == 1 then flags = 393216
-    elseif idx == 1 then flags = 131072
-    elseif idx == num_lines then flags = 262144
-    else flags = 0 end
-    parts[#parts+1] = '<hp:lineseg textpos="' .. textpos .. '" vertpos="' .. vertpos .. '"'
-      .. ' vertsize="' .. vertsize .. '" textheight="' .. vertsize .. '"'
-      .. ' baseline="' .. baseline .. '" spacing="' .. spacing .. '"'
-      .. ' horzpos="0" horzsize="' .. horzsize .. '" flags="' .. flags .. '"/>'
+    local flags = (idx == 1 and 0x20000 or 0) | (idx == num_lines and 0x40000 or 0)
+    parts[#parts+1] = '<hp:lineseg textpos="' .. textpos .. '" vertpos="' .. (idx - 1) * line_height
+      .. seg_tail .. flags .. '"/>'
   end
   parts[#parts+1] = '</hp:linesegarray>'
   return table.concat(parts)
@@ -285,21 +377,60 @@ end
 -- PART 7: XML Builders
 -- ══════════════════════════════════════════════════════════════════════
 
+-- Paragraph skeleton. PARA_TAIL_XML is everything after the id (paraPr,
+-- style, runs, lineseg); PARA_XML takes the id first; PARA_OPEN_XML is
+-- the start tag alone (id, paraPr, style) for paragraphs wrapping a table
+local PARA_TAIL_XML = '" paraPrIDRef="%s" styleIDRef="%s"'
+  .. ' pageBreak="0" columnBreak="0" merged="0">%s%s</hp:p>'
+local PARA_XML = '<hp:p id="%d' .. PARA_TAIL_XML
+local PARA_OPEN_XML = PARA_XML:sub(1, -#'%s%s</hp:p>' - 1)
+
+-- Markup following the id of an empty paragraph, keyed by charPr/style/paraPr
+local empty_paragraph_tails = {}
+
 local function make_paragraph_xml(text, char_pr_id, style_id, para_pr_id)
   char_pr_id = char_pr_id or '0'
   style_id = style_id or '0'
   para_pr_id = para_pr_id or '0'
   local pid = next_para_id()
+  if not text or text == '' then
+    -- Empty separators differ only in their id: build the rest once
+    local key = char_pr_id .. ':' .. style_id .. ':' .. para_pr_id
+    local tail = empty_paragraph_tails[key]
+    if not tail then
+      local ch = CHAR_HEIGHT_BY_ID[char_pr_id] or CHAR_HEIGHT_NORMAL
+      tail = PARA_TAIL_XML:format(para_pr_id, style_id,
+        '<hp:run charPrIDRef="' .. char_pr_id .. '"><hp:t></hp:t></hp:run>',
+        compute_lineseg_xml('', ch))
+      empty_paragraph_tails[key] = tail
+    end
+    return '<hp:p id="' .. pid .. tail
+  end
   local safe_text = xml_escape(text)
-  local ch = CHAR_HEIGHT_MAP[tonumber(char_pr_id) or 0] or CHAR_HEIGHT_NORMAL
-  local lineseg = compute_lineseg_xml(text, ch)
-  return '<hp:p id="' .. pid .. '" paraPrIDRef="' .. para_pr_id .. '"'
-    .. ' styleIDRef="' .. style_id .. '"'
-    .. ' pageBreak="0" columnBreak="0" merged="0">'
-    .. '<hp:run charPrIDRef="' .. char_pr_id .. '">'
-    .. '<hp:t>' .. safe_text .. '</hp:t></hp:run>'
-    .. lineseg
-    .. '</hp:p>'
+  local ch = CHAR_HEIGHT_BY_ID[char_pr_id] or CHAR_HEIGHT_NORMAL
+  -- Title, TOC and code paragraphs repeat the same text: lay it out once
+  local by_text = paragraph_lineseg_cache[ch]
+  if not by_text then
+    by_text = {}
+    paragraph_lineseg_cache[ch] = by_text
+  end
+  local lineseg = by_text[text]
+  if not lineseg then
+    lineseg = compute_lineseg_xml(text, ch)
+    by_text[text] = lineseg
+  end
+  return PARA_XML:format(pid, para_pr_id, style_id,
+    '<hp:run charPrIDRef="' .. char_pr_id .. '"><hp:t>' .. safe_text .. '</hp:t></hp:run>',
+    lineseg)
+end
+
+-- Horizontal rules differ only in their paragraph id: build the rest once
+local HR_PARAGRAPH_TAIL = PARA_TAIL_XML:format('0', '0',
+  '<hp:run charPrIDRef="0"><hp:t>' .. HR_TEXT .. '</hp:t></hp:run>',
+  compute_lineseg_xml(HR_TEXT))
+
+local function make_hr_paragraph_xml()
+  return '<hp:p id="' .. next_para_id() .. HR_PARAGRAPH_TAIL
 end
 
 local function make_rich_paragraph_xml(runs_xml, lineseg_text, style_id, para_pr_id)
@@ -310,37 +441,46 @@ local function make_rich_paragraph_xml(runs_xml, lineseg_text, style_id, para_pr
   if lineseg_text then
     lineseg = compute_lineseg_xml(lineseg_text)
   end
-  return '<hp:p id="' .. pid .. '" paraPrIDRef="' .. para_pr_id .. '"'
-    .. ' styleIDRef="' .. style_id .. '"'
-    .. ' pageBreak="0" columnBreak="0" merged="0">'
-    .. runs_xml .. lineseg .. '</hp:p>'
+  return PARA_XML:format(pid, para_pr_id, style_id, runs_xml, lineseg)
 end
 
+-- charPr markup after the id depends only on the formatting, which
+-- repeats across headings, runs and conversions: build each variant once
+local charpr_body_cache = {}
+
 local function make_charpr_xml(cpr_id, height, opts)
   opts = opts or {}
-  local bold_attr = opts.bold and ' bold="1"' or ''
-  local italic_attr = opts.italic and ' italic="1"' or ''
-  local color = opts.text_color or '#000000'
-  local ul_type = opts.underline and 'BOTTOM' or 'NONE'
-  local ul_color = opts.text_color or '#000000'
-  local so_shape = opts.strikeout and 'SOLID' or 'NONE'
   local font_ref = opts.font_ref or 0
-  return '<hh:charPr id="' .. cpr_id .. '" height="' .. height .. '"'
-    .. ' textColor="' .. color .. '" shadeColor="none"'
-    .. ' useFontSpace="0" useKerning="0" symMark="NONE"'
-    .. ' borderFillIDRef="2"' .. bold_attr .. italic_attr .. '>'
-    .. '<hh:fontRef hangul="' .. font_ref .. '" latin="' .. font_ref .. '"'
-    .. ' hanja="' .. font_ref .. '" japanese="' .. font_ref .. '"'
-    .. ' other="' .. font_ref .. '" symbol="' .. font_ref .. '" user="' .. font_ref .. '"/>'
-    .. '<hh:ratio hangul="100" latin="100" hanja="100" japanese="100" other="100" symbol="100" user="100"/>'
-    .. '<hh:spacing hangul="0" latin="0" hanja="0" japanese="0" other="0" symbol="0" user="0"/>'
-    .. '<hh:relSz hangul="100" latin="100" hanja="100" japanese="100" other="100" symbol="100" user="100"/>'
-    .. '<hh:offset hangul="0" latin="0" hanja="0" japanese="0" other="0" symbol="0" user="0"/>'
-    .. '<hh:underline type="' .. ul_type .. '" shape="SOLID" color="' .. ul_color .. '"/>'
-    .. '<hh:strikeout shape="' .. so_shape .. '" color="#000000"/>'
-    .. '<hh:outline type="NONE"/>'
-    .. '<hh:shadow type="NONE" color="#C0C0C0" offsetX="10" offsetY="10"/>'
-    .. '</hh:charPr>'
+  local key = height .. ':' .. font_ref .. ':' .. (opts.text_color or '')
+    .. (opts.bold and 'b' or '') .. (opts.italic and 'i' or '')
+    .. (opts.underline and 'u' or '') .. (opts.strikeout and 's' or '')
+  local body = charpr_body_cache[key]
+  if not body then
+    local bold_attr = opts.bold and ' bold="1"' or ''
+    local italic_attr = opts.italic and ' italic="1"' or ''
+    local color = opts.text_color or '#000000'
+    local ul_type = opts.underline and 'BOTTOM' or 'NONE'
+    local ul_color = opts.text_color or '#000000'
+    local so_shape = opts.strikeout and 'SOLID' or 'NONE'
+    body = '" height="' .. height .. '"'
+      .. ' textColor="' .. color .. '" shadeColor="none"'
+      .. ' useFontSpace="0" useKerning="0" symMark="NONE"'
+      .. ' borderFillIDRef="2"' .. bold_attr .. italic_attr .. '>'
+      .. '<hh:fontRef hangul="' .. font_ref .. '" latin="' .. font_ref .. '"'
+      .. ' hanja="' .. font_ref .. '" japanese="' .. font_ref .. '"'
+      .. ' other="' .. font_ref .. '" symbol="' .. font_ref .. '" user="' .. font_ref .. '"/>'
+      .. '<hh:ratio hangul="100" latin="100" hanja="100" japanese="100" other="100" symbol="100" user="100"/>'
+      .. '<hh:spacing hangul="0" latin="0" hanja="0" japanese="0" other="0" symbol="0" user="0"/>'
+      .. '<hh:relSz hangul="100" latin="100" hanja="100" japanese="100" other="100" symbol="100" user="100"/>'
+      .. '<hh:offset hangul="0" latin="0" hanja="0" japanese="0" other="0" symbol="0" user="0"/>'
+      .. '<hh:underline type="' .. ul_type .. '" shape="SOLID" color="' .. ul_color .. '"/>'
+      .. '<hh:strikeout shape="' .. so_shape .. '" color="#000000"/>'
+      .. '<hh:outline type="NONE"/>'
+      .. '<hh:shadow type="NONE" color="#C0C0C0" offsetX="10" offsetY="10"/>'
+      .. '</hh:charPr>'
+    charpr_body_cache[key] = body
+  end
+  return '<hh:charPr id="' .. cpr_id .. body
 end
 
 local function make_font_xml(font_id, face_name)
@@ -350,18 +490,17 @@ local function make_font_xml(font_id, face_name)
     .. '</hh:font>'
 end
 
-local function make_table_borderfill_xml()
-  return '<hh:borderFill id="' .. TABLE_BORDER_FILL_ID .. '" threeD="0"'
-    .. ' shadow="0" centerLine="NONE" breakCellSeparateLine="0">'
-    .. '<hh:slash type="NONE" Crooked="0" isCounter="0"/>'
-    .. '<hh:backSlash type="NONE" Crooked="0" isCounter="0"/>'
-    .. '<hh:leftBorder type="SOLID" width="0.12 mm" color="#000000"/>'
-    .. '<hh:rightBorder type="SOLID" width="0.12 mm" color="#000000"/>'
-    .. '<hh:topBorder type="SOLID" width="0.12 mm" color="#000000"/>'
-    .. '<hh:bottomBorder type="SOLID" width="0.12 mm" color="#000000"/>'
-    .. '<hh:diagonal type="NONE" width="0.12 mm" color="#000000"/>'
-    .. '</hh:borderFill>'
-end
+-- Table borderFill is fully static: built once at load
+local TABLE_BORDER_FILL_XML = '<hh:borderFill id="' .. TABLE_BORDER_FILL_ID .. '" threeD="0"'
+  .. ' shadow="0" centerLine="NONE" breakCellSeparateLine="0">'
+  .. '<hh:slash type="NONE" Crooked="0" isCounter="0"/>'
+  .. '<hh:backSlash type="NONE" Crooked="0" isCounter="0"/>'
+  .. '<hh:leftBorder type="SOLID" width="0.12 mm" color="#000000"/>'
+  .. '<hh:rightBorder type="SOLID" width="0.12 mm" color="#000000"/>'
+  .. '<hh:topBorder type="SOLID" width="0.12 mm" color="#000000"/>'
+  .. '<hh:bottomBorder type="SOLID" width="0.12 mm" color="#000000"/>'
+  .. '<hh:diagonal type="NONE" width="0.12 mm" color="#000000"/>'
+  .. '</hh:borderFill>'
 
 local function make_callout_borderfill_xml(bf_id, border_color, bg_color)
   return '<hh:borderFill id="' .. bf_id .. '" threeD="0"'
@@ -383,69 +522,102 @@ end
 -- PART 8: CharPr Management (built-in mode only)
 -- ══════════════════════════════════════════════════════════════════════
 
-local function formats_key(base_id, formats)
-  local sorted = {}
-  for fmt in pairs(formats) do sorted[#sorted+1] = fmt end
-  table.sort(sorted)
-  return base_id .. ':' .. table.concat(sorted, ',')
+-- Run formats as bit flags: a format set is one integer, combined with |
+local FMT_BOLD        = 1
+local FMT_ITALIC      = 2
+local FMT_UNDERLINE   = 4
+local FMT_STRIKEOUT   = 8
+local FMT_SUPERSCRIPT = 16
+local FMT_SUBSCRIPT   = 32
+local FMT_COLOR_BLUE  = 64
+
+-- What a format variant inherits from its base charPr: height, font ref
+-- and whether the base is already bold (ids 7 and 8)
+local BASE_ID_INFO = {}
+for base_id, height in pairs(CHAR_HEIGHT_MAP) do
+  BASE_ID_INFO[base_id] = {
+    height = height,
+    font_ref = (base_id == CODE_CHAR_PR_ID) and CODE_FONT_REF or 0,
+    bold = base_id == 7 or base_id == 8,
+  }
 end
+local DEFAULT_BASE_INFO = { height = 1000, font_ref = 0, bold = false }
 
 local function get_builtin_char_pr_id(base_id, active_formats)
-  if not active_formats or not next(active_formats) then
+  if not active_formats or active_formats == 0 then
     return tostring(base_id)
   end
-  local key = formats_key(tostring(base_id), active_formats)
+  local key = base_id .. ':' .. active_formats
   if char_pr_cache[key] then
     return char_pr_cache[key].id
   end
   max_char_pr_id = max_char_pr_id + 1
   local new_id = tostring(max_char_pr_id)
-  char_pr_cache[key] = {
+  -- base_id is kept numeric for the header pass; id stays the string
+  -- returned to run markup
+  local entry = {
     id = new_id,
-    base_id = tostring(base_id),
+    base_id = tonumber(base_id) or 0,
     formats = active_formats,
   }
+  char_pr_cache[key] = entry
+  char_pr_entries[#char_pr_entries+1] = entry
   return new_id
 end
 
+-- Bold body text (callout titles, TOC entries, gt header cells): the id is
+-- fixed for a conversion, so register it once instead of per use
+local function get_bold_char_pr_id()
+  if not bold_char_pr_id then
+    bold_char_pr_id = get_builtin_char_pr_id('0', FMT_BOLD)
+  end
+  return bold_char_pr_id
+end
+
 -- ══════════════════════════════════════════════════════════════════════
 -- PART 9: Plain Text Extraction
 -- ══════════════════════════════════════════════════════════════════════
 
+local function push_reversed(stack, list)
+  if not list then return end
+  for i = #list, 1, -1 do stack[#stack+1] = list[i] end
+end
+
+-- Inline types keyed for one table lookup per item instead of an elseif chain
+local PLAIN_TEXT_FIXED = { Space = ' ', SoftBreak = ' ', LineBreak = '\n' }
+local PLAIN_TEXT_FIELD = { Str = true, Code = true, Math = true }
+local PLAIN_TEXT_CONTAINER = {
+  Strong = true, Emph = true, Strikeout = true, Superscript = true,
+  Subscript = true, SmallCaps = true, Underline = true,
+  Link = true, Image = true, Cite = true, Span = true,
+}
+
 local function get_plain_text(inlines)
   if not inlines then return '' end
   local parts = {}
-  for _, item in ipairs(inlines) do
-    local t = item.t
-    if t == 'Str' then
-      parts[#parts+1] = item.text
-    elseif t == 'Space' then
-      parts[#parts+1] = ' '
-    elseif t == 'SoftBreak' then
-      parts[#parts+1] = ' '
-    elseif t == 'LineBreak' then
-      parts[#parts+1] = '\n'
-    elseif t == 'Strong' or t == 'Emph' or t == 'Strikeout'
-        or t == 'Superscript' or t == 'Subscript'
-        or t == 'SmallCaps' or t == 'Underline' then
-      parts[#parts+1] = get_plain_text(item.content)
-    elseif t == 'Code' then
-      parts[#parts+1] = item.text
-    elseif t == 'Link' then
-      parts[#parts+1] = get_plain_text(item.content)
-    elseif t == 'Image' then
-      parts[#parts+1] = get_plain_text(item.content)
-    elseif t == 'Quoted' then
-      local qt = item.quotetype
-      local q1 = qt == 'DoubleQuote' and '\u{201c}' or '\u{2018}'
-      local q2 = qt == 'DoubleQuote' and '\u{201d}' or '\u{2019}'
-      parts[#parts+1] = q1 .. get_plain_text(item.content) .. q2
-    elseif t == 'Cite' then
-      parts[#parts+1] = get_plain_text(item.content)
-    elseif t == 'Math' then
-      parts[#parts+1] = item.text
-    elseif t == 'Span' then
-      parts[#parts+1] = get_plain_text(item.content)
+  -- Walk with an explicit stack instead of recursing per container;
+  -- plain strings on the stack are text queued behind a container (closing quotes)
+  local stack = {}
+  push_reversed(stack, inlines)
+  while #stack > 0 do
+    local item = stack[#stack]
+    stack[#stack] = nil
+    if type(item) == 'string' then
+      parts[#parts+1] = item
+    else
+      local t = item.t
+      if PLAIN_TEXT_FIELD[t] then
+        parts[#parts+1] = item.text
+      elseif PLAIN_TEXT_FIXED[t] then
+        parts[#parts+1] = PLAIN_TEXT_FIXED[t]
+      elseif PLAIN_TEXT_CONTAINER[t] then
+        push_reversed(stack, item.content)
+      elseif t == 'Quoted' then
+        local dq = item.quotetype == 'DoubleQuote'
+        parts[#parts+1] = dq and '\u{201c}' or '\u{2018}'
+        stack[#stack+1] = dq and '\u{201d}' or '\u{2019}'
+        push_reversed(stack, item.content)
+      end
     end
   end
   return table.concat(parts)
@@ -460,15 +632,16 @@ local last_field_id = '0'
 local function create_field_begin(url)
   local fid = unique_id()
   last_field_id = fid
-  local command_url = url:gsub(':', '\\:'):gsub('%?', '\\?')
-  local command_str = command_url .. ';1;5;-1;'
+  -- Escape once; Command is the same URL with ':' and '?' backslashed
+  local safe_url = xml_escape(url)
+  local command_str = safe_url:gsub('[:?]', '\\%0') .. ';1;5;-1;'
   return '<hp:run charPrIDRef="0"><hp:ctrl>'
     .. '<hp:fieldBegin id="' .. fid .. '" type="HYPERLINK" name=""'
     .. ' editable="0" dirty="1" zorder="-1" fieldid="' .. fid .. '" metaTag="">'
     .. '<hp:parameters cnt="6" name="">'
     .. '<hp:integerParam name="Prop">0</hp:integerParam>'
     .. '<hp:stringParam name="Command">' .. command_str .. '</hp:stringParam>'
-    .. '<hp:stringParam name="Path">' .. xml_escape(url) .. '</hp:stringParam>'
+    .. '<hp:stringParam name="Path">' .. safe_url .. '</hp:stringParam>'
     .. '<hp:stringParam name="Category">HWPHYPERLINK_TYPE_URL</hp:stringParam>'
     .. '<hp:stringParam name="TargetType">HWPHYPERLINK_TARGET_HYPERLINK</hp:stringParam>'
     .. '<hp:stringParam name="DocOpenType">HWPHYPERLINK_JUMP_DONTCARE</hp:stringParam>'
@@ -507,7 +680,16 @@ end
 -- PART 11: Image Handling
 -- ══════════════════════════════════════════════════════════════════════
 
-local input_dir = './'
+-- Directory prefix of the input file ('' = current directory)
+local input_dir = ''
+local resolved_image_paths = {}
+
+-- Millimetres per unit; unitless and unknown units count as pixels
+local PX_TO_MM = 25.4 / 96.0
+local UNIT_TO_MM = {
+  [''] = PX_TO_MM, px = PX_TO_MM, ['in'] = 25.4, cm = 10.0, mm = 1.0,
+  pt = 25.4 / 72.0, ['%'] = 1.5,
+}
 
 local function parse_dimension(val_str)
   if not val_str or val_str == '' then return nil end
@@ -516,28 +698,72 @@ local function parse_dimension(val_str)
   if not val then return nil end
   val = tonumber(val)
   if not val then return nil end
-  local mm_val
-  if unit == '' or unit == 'px' then mm_val = val * (25.4/96.0)
-  elseif unit == 'in' then mm_val = val * 25.4
-  elseif unit == 'cm' then mm_val = val * 10.0
-  elseif unit == 'mm' then mm_val = val
-  elseif unit == 'pt' then mm_val = val * (25.4/72.0)
-  elseif unit == '%' then mm_val = val * 1.5
-  else mm_val = val * (25.4/96.0)
-  end
-  return math.floor(mm_val * LUNIT_PER_MM)
+  return math.floor(val * (UNIT_TO_MM[unit] or PX_TO_MM) * LUNIT_PER_MM)
 end
 
 local function resolve_image_path(target_url)
+  -- Memoized per conversion: figures are often referenced more than once
+  local cached = resolved_image_paths[target_url]
+  if cached ~= nil then return cached or nil end
+  local resolved = nil
   if target_url:match('^/') and file_exists(target_url) then
-    return target_url
+    resolved = target_url
+  else
+    local candidate = input_dir .. target_url
+    if file_exists(candidate) then
+      resolved = candidate
+    elseif candidate ~= target_url and file_exists(target_url) then
+      resolved = target_url
+    end
   end
-  local candidate = input_dir .. target_url
-  if file_exists(candidate) then return candidate end
-  if file_exists(target_url) then return target_url end
-  return nil
+  resolved_image_paths[target_url] = resolved or false
+  return resolved
 end
 
+-- BinData extension by source file extension (anything else is stored as png)
+local IMAGE_EXT = { jpg = 'jpg', jpeg = 'jpg', gif = 'gif', bmp = 'bmp' }
+
+-- Picture instIds count up from above unique_id()'s range so they never collide
+local IMAGE_INST_ID_BASE = 200000000
+
+-- Picture run; the slots are, in order: charPr, pic id, instid,
+-- orgSz w/h, curSz w/h, binary item, imgRect pt1 x, pt2 x/y, pt3 y, sz w/h
+local PIC_RUN_XML = '<hp:run charPrIDRef="%s">'
+  .. '<hp:pic id="%s" zOrder="0" numberingType="NONE"'
+  .. ' textWrap="TOP_AND_BOTTOM" textFlow="BOTH_SIDES" lock="0"'
+  .. ' dropcapstyle="None" href="" groupLevel="0"'
+  .. ' instid="%s" reverse="0">'
+  .. '<hp:offset x="0" y="0"/>'
+  .. '<hp:orgSz width="%s" height="%s"/>'
+  .. '<hp:curSz width="%s" height="%s"/>'
+  .. '<hp:flip horizontal="0" vertical="0"/>'
+  .. '<hp:rotationInfo angle="0" centerX="0" centerY="0" rotateimage="1"/>'
+  .. '<hp:renderingInfo>'
+  .. '<hc:transMatrix e1="1" e2="0" e3="0" e4="0" e5="1" e6="0"/>'
+  .. '<hc:scaMatrix e1="1" e2="0" e3="0" e4="0" e5="1" e6="0"/>'
+  .. '<hc:rotMatrix e1="1" e2="0" e3="0" e4="0" e5="1" e6="0"/>'
+  .. '</hp:renderingInfo>'
+  .. '<hc:img binaryItemIDRef="%s" bright="0"'
+  .. ' contrast="0" effect="REAL_PIC" alpha="0"/>'
+  .. '<hp:imgRect>'
+  .. '<hc:pt0 x="0" y="0"/><hc:pt1 x="%s" y="0"/>'
+  .. '<hc:pt2 x="%s" y="%s"/><hc:pt3 x="0" y="%s"/>'
+  .. '</hp:imgRect>'
+  .. '<hp:imgClip left="0" right="0" top="0" bottom="0"/>'
+  .. '<hp:inMargin left="0" right="0" top="0" bottom="0"/>'
+  .. '<hp:imgDim dimwidth="0" dimheight="0"/>'
+  .. '<hp:effects/>'
+  .. '<hp:sz width="%s" widthRelTo="ABSOLUTE"'
+  .. ' height="%s" heightRelTo="ABSOLUTE" protect="0"/>'
+  .. '<hp:pos treatAsChar="1" affectLSpacing="0" flowWithText="1"'
+  .. ' allowOverlap="1" holdAnchorAndSO="0" vertRelTo="PARA"'
+  .. ' horzRelTo="COLUMN" vertAlign="TOP" horzAlign="LEFT"'
+  .. ' vertOffset="0" horzOffset="0"/>'
+  .. '<hp:outMargin left="0" right="0" top="0" bottom="0"/>'
+  .. '<hp:shapeComment/>'
+  .. '</hp:pic>'
+  .. '</hp:run>'
+
 local function handle_image(img_inline, char_pr_id)
   char_pr_id = char_pr_id or '0'
   local target_url = img_inline.src
@@ -580,13 +806,10 @@ local function handle_image(img_inline, char_pr_id)
     height_hwp = math.floor(height_hwp * ratio)
   end
 
-  local binary_item_id = 'img_' .. tostring(math.floor(os.clock()*1000000)) .. '_' .. tostring(math.random(0, 1000000))
-  local ext = 'png'
-  local lower = target_url:lower()
-  if lower:match('%.jpe?g$') then ext = 'jpg'
-  elseif lower:match('%.gif$') then ext = 'gif'
-  elseif lower:match('%.bmp$') then ext = 'bmp'
-  end
+  -- Sequential ids are unique within the package without clock/random calls
+  image_counter = image_counter + 1
+  local binary_item_id = 'img_' .. image_counter
+  local ext = IMAGE_EXT[(target_url:match('%.(%w+)$') or ''):lower()] or 'png'
 
   images[#images+1] = {
     id = binary_item_id,
@@ -596,122 +819,80 @@ local function handle_image(img_inline, char_pr_id)
   }
 
   local pic_id = unique_id()
-  local inst_id = tostring(math.random(10000000, 99999999))
+  local inst_id = IMAGE_INST_ID_BASE + image_counter
   local w, h = width_hwp, height_hwp
 
-  return '<hp:run charPrIDRef="' .. char_pr_id .. '">'
-    .. '<hp:pic id="' .. pic_id .. '" zOrder="0" numberingType="NONE"'
-    .. ' textWrap="TOP_AND_BOTTOM" textFlow="BOTH_SIDES" lock="0"'
-    .. ' dropcapstyle="None" href="" groupLevel="0"'
-    .. ' instid="' .. inst_id .. '" reverse="0">'
-    .. '<hp:offset x="0" y="0"/>'
-    .. '<hp:orgSz width="' .. w .. '" height="' .. h .. '"/>'
-    .. '<hp:curSz width="' .. w .. '" height="' .. h .. '"/>'
-    .. '<hp:flip horizontal="0" vertical="0"/>'
-    .. '<hp:rotationInfo angle="0" centerX="0" centerY="0" rotateimage="1"/>'
-    .. '<hp:renderingInfo>'
-    .. '<hc:transMatrix e1="1" e2="0" e3="0" e4="0" e5="1" e6="0"/>'
-    .. '<hc:scaMatrix e1="1" e2="0" e3="0" e4="0" e5="1" e6="0"/>'
-    .. '<hc:rotMatrix e1="1" e2="0" e3="0" e4="0" e5="1" e6="0"/>'
-    .. '</hp:renderingInfo>'
-    .. '<hc:img binaryItemIDRef="' .. binary_item_id .. '" bright="0"'
-    .. ' contrast="0" effect="REAL_PIC" alpha="0"/>'
-    .. '<hp:imgRect>'
-    .. '<hc:pt0 x="0" y="0"/><hc:pt1 x="' .. w .. '" y="0"/>'
-    .. '<hc:pt2 x="' .. w .. '" y="' .. h .. '"/><hc:pt3 x="0" y="' .. h .. '"/>'
-    .. '</hp:imgRect>'
-    .. '<hp:imgClip left="0" right="0" top="0" bottom="0"/>'
-    .. '<hp:inMargin left="0" right="0" top="0" bottom="0"/>'
-    .. '<hp:imgDim dimwidth="0" dimheight="0"/>'
-    .. '<hp:effects/>'
-    .. '<hp:sz width="' .. w .. '" widthRelTo="ABSOLUTE"'
-    .. ' height="' .. h .. '" heightRelTo="ABSOLUTE" protect="0"/>'
-    .. '<hp:pos treatAsChar="1" affectLSpacing="0" flowWithText="1"'
-    .. ' allowOverlap="1" holdAnchorAndSO="0" vertRelTo="PARA"'
-    .. ' horzRelTo="COLUMN" vertAlign="TOP" horzAlign="LEFT"'
-    .. ' vertOffset="0" horzOffset="0"/>'
-    .. '<hp:outMargin left="0" right="0" top="0" bottom="0"/>'
-    .. '<hp:shapeComment/>'
-    .. '</hp:pic>'
-    .. '</hp:run>'
+  return PIC_RUN_XML:format(char_pr_id, pic_id, inst_id, w, h, w, h,
+    binary_item_id, w, w, h, h, w, h)
 end
 
 -- ══════════════════════════════════════════════════════════════════════
 -- PART 12: Inline Processing
 -- ══════════════════════════════════════════════════════════════════════
 
+-- Inline containers that only add a format flag to their content
+local INLINE_FORMAT_FLAGS = {
+  Strong = FMT_BOLD, Emph = FMT_ITALIC, Underline = FMT_UNDERLINE,
+  Strikeout = FMT_STRIKEOUT, Superscript = FMT_SUPERSCRIPT, Subscript = FMT_SUBSCRIPT,
+}
+
+-- Inline containers rendered as their content with unchanged formatting
+local INLINE_PASSTHROUGH = { Cite = true, Span = true, SmallCaps = true }
+
 local function process_inlines(inlines, base_char_pr_id, active_formats)
   base_char_pr_id = base_char_pr_id or '0'
-  active_formats = active_formats or {}
+  active_formats = active_formats or 0
   local xml_parts = {}
   local text_parts = {}
 
+  -- Base and formats are fixed for this call: resolve the charPr id on
+  -- first use instead of rebuilding the formats key for every run
+  local current_id, run_open
   local function get_current_id()
-    return get_builtin_char_pr_id(base_char_pr_id, active_formats)
+    if not current_id then
+      current_id = get_builtin_char_pr_id(base_char_pr_id, active_formats)
+    end
+    return current_id
+  end
+  local function get_run_open()
+    if not run_open then
+      run_open = '<hp:run charPrIDRef="' .. get_current_id() .. '"><hp:t>'
+    end
+    return run_open
   end
 
   for _, item in ipairs(inlines) do
     local t = item.t
 
     if t == 'Str' then
-      local cid = get_current_id()
-      xml_parts[#xml_parts+1] = '<hp:run charPrIDRef="' .. cid .. '"><hp:t>' .. xml_escape(item.text) .. '</hp:t></hp:run>'
+      xml_parts[#xml_parts+1] = get_run_open() .. xml_escape(item.text) .. RUN_TEXT_CLOSE
       text_parts[#text_parts+1] = item.text
 
-    elseif t == 'Space' then
-      local cid = get_current_id()
-      xml_parts[#xml_parts+1] = '<hp:run charPrIDRef="' .. cid .. '"><hp:t> </hp:t></hp:run>'
-      text_parts[#text_parts+1] = ' '
-
-    elseif t == 'SoftBreak' then
-      local cid = get_current_id()
-      xml_parts[#xml_parts+1] = '<hp:run charPrIDRef="' .. cid .. '"><hp:t> </hp:t></hp:run>'
+    elseif t == 'Space' or t == 'SoftBreak' then
+      xml_parts[#xml_parts+1] = get_run_open() .. ' ' .. RUN_TEXT_CLOSE
       text_parts[#text_parts+1] = ' '
 
     elseif t == 'LineBreak' then
-      local cid = get_current_id()
-      xml_parts[#xml_parts+1] = '<hp:run charPrIDRef="' .. cid .. '"><hp:t><hp:lineBreak/></hp:t></hp:run>'
+      xml_parts[#xml_parts+1] = get_run_open() .. '<hp:lineBreak/>' .. RUN_TEXT_CLOSE
       text_parts[#text_parts+1] = '\n'
 
-    elseif t == 'Strong' then
-      local new_fmts = {}; for k,v in pairs(active_formats) do new_fmts[k]=v end; new_fmts['BOLD']=true
-      local runs, txt = process_inlines(item.content, base_char_pr_id, new_fmts)
-      xml_parts[#xml_parts+1] = runs; text_parts[#text_parts+1] = txt
-
-    elseif t == 'Emph' then
-      local new_fmts = {}; for k,v in pairs(active_formats) do new_fmts[k]=v end; new_fmts['ITALIC']=true
-      local runs, txt = process_inlines(item.content, base_char_pr_id, new_fmts)
+    elseif INLINE_FORMAT_FLAGS[t] then
+      local runs, txt = process_inlines(item.content, base_char_pr_id,
+        active_formats | INLINE_FORMAT_FLAGS[t])
       xml_parts[#xml_parts+1] = runs; text_parts[#text_parts+1] = txt
 
-    elseif t == 'Underline' then
-      local new_fmts = {}; for k,v in pairs(active_formats) do new_fmts[k]=v end; new_fmts['UNDERLINE']=true
-      local runs, txt = process_inlines(item.content, base_char_pr_id, new_fmts)
-      xml_parts[#xml_parts+1] = runs; text_parts[#text_parts+1] = txt
-
-    elseif t == 'Strikeout' then
-      local new_fmts = {}; for k,v in pairs(active_formats) do new_fmts[k]=v end; new_fmts['STRIKEOUT']=true
-      local runs, txt = process_inlines(item.content, base_char_pr_id, new_fmts)
-      xml_parts[#xml_parts+1] = runs; text_parts[#text_parts+1] = txt
-
-    elseif t == 'Superscript' then
-      local new_fmts = {}; for k,v in pairs(active_formats) do new_fmts[k]=v end; new_fmts['SUPERSCRIPT']=true
-      local runs, txt = process_inlines(item.content, base_char_pr_id, new_fmts)
-      xml_parts[#xml_parts+1] = runs; text_parts[#text_parts+1] = txt
-
-    elseif t == 'Subscript' then
-      local new_fmts = {}; for k,v in pairs(active_formats) do new_fmts[k]=v end; new_fmts['SUBSCRIPT']=true
-      local runs, txt = process_inlines(item.content, base_char_pr_id, new_fmts)
+    elseif INLINE_PASSTHROUGH[t] then
+      local runs, txt = process_inlines(item.content, base_char_pr_id, active_formats)
       xml_parts[#xml_parts+1] = runs; text_parts[#text_parts+1] = txt
 
     elseif t == 'Code' then
-      xml_parts[#xml_parts+1] = '<hp:run charPrIDRef="' .. CODE_CHAR_PR_ID .. '"><hp:t>' .. xml_escape(item.text) .. '</hp:t></hp:run>'
+      xml_parts[#xml_parts+1] = CODE_RUN_OPEN .. xml_escape(item.text) .. RUN_TEXT_CLOSE
       text_parts[#text_parts+1] = item.text
 
     elseif t == 'Link' then
       xml_parts[#xml_parts+1] = create_field_begin(item.target)
-      local new_fmts = {}; for k,v in pairs(active_formats) do new_fmts[k]=v end
-      new_fmts['UNDERLINE']=true; new_fmts['COLOR_BLUE']=true
-      local runs, txt = process_inlines(item.content, base_char_pr_id, new_fmts)
+      local runs, txt = process_inlines(item.content, base_char_pr_id,
+        active_formats | FMT_UNDERLINE | FMT_COLOR_BLUE)
       xml_parts[#xml_parts+1] = runs; text_parts[#text_parts+1] = txt
       xml_parts[#xml_parts+1] = create_field_end()
 
@@ -733,25 +914,12 @@ local function process_inlines(inlines, base_char_pr_id, active_formats)
       local qt = item.quotetype
       local q1 = qt == 'DoubleQuote' and '\u{201c}' or '\u{2018}'
       local q2 = qt == 'DoubleQuote' and '\u{201d}' or '\u{2019}'
-      local cid = get_current_id()
-      xml_parts[#xml_parts+1] = '<hp:run charPrIDRef="' .. cid .. '"><hp:t>' .. q1 .. '</hp:t></hp:run>'
+      xml_parts[#xml_parts+1] = get_run_open() .. q1 .. RUN_TEXT_CLOSE
       local runs, txt = process_inlines(item.content, base_char_pr_id, active_formats)
       xml_parts[#xml_parts+1] = runs
-      xml_parts[#xml_parts+1] = '<hp:run charPrIDRef="' .. cid .. '"><hp:t>' .. q2 .. '</hp:t></hp:run>'
+      xml_parts[#xml_parts+1] = get_run_open() .. q2 .. RUN_TEXT_CLOSE
       text_parts[#text_parts+1] = q1 .. txt .. q2
 
-    elseif t == 'Cite' then
-      local runs, txt = process_inlines(item.content, base_char_pr_id, active_formats)
-      xml_parts[#xml_parts+1] = runs; text_parts[#text_parts+1] = txt
-
-    elseif t == 'Span' then
-      local runs, txt = process_inlines(item.content, base_char_pr_id, active_formats)
-      xml_parts[#xml_parts+1] = runs; text_parts[#text_parts+1] = txt
-
-    elseif t == 'SmallCaps' then
-      local runs, txt = process_inlines(item.content, base_char_pr_id, active_formats)
-      xml_parts[#xml_parts+1] = runs; text_parts[#text_parts+1] = txt
-
     -- RawInline: skip
     end
   end
@@ -763,9 +931,16 @@ end
 -- PART 13: Block Processing
 -- ══════════════════════════════════════════════════════════════════════
 
-local function handle_para_or_plain(inlines, indent_prefix)
+-- Display equations always occupy a single fixed-height line
+local DISPLAY_MATH_LINESEG = '<hp:linesegarray>'
+  .. '<hp:lineseg textpos="0" vertpos="0" vertsize="1600"'
+  .. ' textheight="1600" baseline="1360" spacing="400"'
+  .. ' horzpos="0" horzsize="42520" flags="393216"/>'
+  .. '</hp:linesegarray>'
+
+local function handle_para_or_plain(inlines, indent_prefix, parts)
   indent_prefix = indent_prefix or ''
-  local parts = {}
+  parts = parts or {}
 
   -- Standalone DisplayMath
   if #inlines == 1 and inlines[1].t == 'Math' then
@@ -773,14 +948,8 @@ local function handle_para_or_plain(inlines, indent_prefix)
     if mtype == 'DisplayMath' then
       local pid = next_para_id()
       local eq_xml = make_equation_xml(inlines[1].text)
-      parts[#parts+1] = '<hp:p id="' .. pid .. '" paraPrIDRef="0" styleIDRef="0"'
-        .. ' pageBreak="0" columnBreak="0" merged="0">'
-        .. '<hp:run charPrIDRef="0">' .. eq_xml .. '</hp:run>'
-        .. '<hp:linesegarray>'
-        .. '<hp:lineseg textpos="0" vertpos="0" vertsize="1600"'
-        .. ' textheight="1600" baseline="1360" spacing="400"'
-        .. ' horzpos="0" horzsize="42520" flags="393216"/>'
-        .. '</hp:linesegarray></hp:p>'
+      parts[#parts+1] = PARA_XML:format(pid, '0', '0',
+        '<hp:run charPrIDRef="0">' .. eq_xml .. '</hp:run>', DISPLAY_MATH_LINESEG)
       return parts
     end
   end
@@ -801,41 +970,75 @@ local function handle_para_or_plain(inlines, indent_prefix)
 
   local lineseg = compute_lineseg_xml(plain_text)
   local pid = next_para_id()
-  parts[#parts+1] = '<hp:p id="' .. pid .. '" paraPrIDRef="0" styleIDRef="0"'
-    .. ' pageBreak="0" columnBreak="0" merged="0">'
-    .. runs_xml .. lineseg .. '</hp:p>'
+  parts[#parts+1] = PARA_XML:format(pid, '0', '0', runs_xml, lineseg)
   return parts
 end
 
+-- Heading ids as strings plus layout char height, per level; levels
+-- outside HEADING_STYLE render as body text
+local HEADING_PARAMS = {}
+for level, hs in pairs(HEADING_STYLE) do
+  HEADING_PARAMS[level] = {
+    style = tostring(hs.style), para = tostring(hs.para), char = tostring(hs.char),
+    height = CHAR_HEIGHT_MAP[hs.char] or CHAR_HEIGHT_NORMAL,
+  }
+end
+local BODY_HEADING_PARAMS = {style='0', para='0', char='0', height=CHAR_HEIGHT_NORMAL}
+
 local function handle_header(block)
-  local level = block.level
-  local hs = HEADING_STYLE[level] or {style=0, para=0, char=0}
-  local sid = tostring(hs.style)
-  local pid_ref = tostring(hs.para)
-  local base_cid = tostring(hs.char)
+  local hp = HEADING_PARAMS[block.level] or BODY_HEADING_PARAMS
 
-  local runs_xml, plain_text = process_inlines(block.content, base_cid)
-  local ch = CHAR_HEIGHT_MAP[tonumber(base_cid) or 0] or CHAR_HEIGHT_NORMAL
-  local lineseg = compute_lineseg_xml(plain_text, ch)
+  local runs_xml, plain_text = process_inlines(block.content, hp.char)
+  local lineseg = compute_lineseg_xml(plain_text, hp.height)
 
   local pid = next_para_id()
-  return '<hp:p id="' .. pid .. '" paraPrIDRef="' .. pid_ref .. '"'
-    .. ' styleIDRef="' .. sid .. '"'
-    .. ' pageBreak="0" columnBreak="0" merged="0">'
-    .. runs_xml .. lineseg .. '</hp:p>'
+  return PARA_XML:format(pid, hp.para, hp.style, runs_xml, lineseg)
 end
 
-local function handle_code_block(block, indent_prefix)
-  indent_prefix = indent_prefix or ''
-  local parts = {}
-  for line in (block.text .. '\n'):gmatch('([^\n]*)\n') do
-    parts[#parts+1] = make_paragraph_xml(indent_prefix .. line, tostring(CODE_CHAR_PR_ID))
+local function handle_code_block(block, indent_prefix, parts)
+  parts = parts or {}
+  -- Code lines are often the most numerous paragraphs: branch on the
+  -- indent once rather than concatenating an empty prefix per line
+  if indent_prefix and indent_prefix ~= '' then
+    for line in (block.text .. '\n'):gmatch('([^\n]*)\n') do
+      parts[#parts+1] = make_paragraph_xml(indent_prefix .. line, CODE_CHAR_PR_ID_STR)
+    end
+  else
+    for line in (block.text .. '\n'):gmatch('([^\n]*)\n') do
+      parts[#parts+1] = make_paragraph_xml(line, CODE_CHAR_PR_ID_STR)
+    end
   end
   return parts
 end
 
 -- ── Table handling ──────────────────────────────────────────────────
 
+-- Constant parts of the table and cell markup; only ids, counts, sizes,
+-- addresses and the header flag vary
+local TABLE_OPEN_ATTRS = '" zOrder="0" numberingType="TABLE"'
+  .. ' textWrap="TOP_AND_BOTTOM" textFlow="BOTH_SIDES" lock="0"'
+  .. ' dropcapstyle="None" pageBreak="CELL" repeatHeader="1"'
+local TABLE_POS_XML = '<hp:pos treatAsChar="1" affectLSpacing="0" flowWithText="1"'
+  .. ' allowOverlap="0" holdAnchorAndSO="0" vertRelTo="PARA"'
+  .. ' horzRelTo="COLUMN" vertAlign="TOP" horzAlign="CENTER"'
+  .. ' vertOffset="0" horzOffset="0"/>'
+local TABLE_OUT_MARGIN_XML = '<hp:outMargin left="0" right="0" top="141" bottom="141"/>'
+local TABLE_IN_MARGIN_XML = '<hp:inMargin left="0" right="0" top="0" bottom="0"/>'
+local TABLE_LAYOUT_XML = TABLE_POS_XML .. TABLE_OUT_MARGIN_XML .. TABLE_IN_MARGIN_XML
+
+-- Cell opening up to the subList id, by header flag
+local TABLE_CELL_OPEN = {}
+for _, flag in ipairs({'0', '1'}) do
+  TABLE_CELL_OPEN[flag] = '<hp:tc name="" header="' .. flag .. '" hasMargin="0"'
+    .. ' protect="0" editable="0" dirty="0" borderFillIDRef="' .. TABLE_BORDER_FILL_ID .. '">'
+    .. '<hp:subList id="'
+end
+local TABLE_SUBLIST_ATTRS = '" textDirection="HORIZONTAL" lineWrap="BREAK" vertAlign="CENTER"'
+  .. ' linkListIDRef="0" linkListNextIDRef="0" textWidth="0"'
+  .. ' textHeight="0" hasTextRef="0" hasNumRef="0">'
+local TABLE_CELL_CLOSE = '<hp:cellMargin left="141" right="141" top="141" bottom="141"/>'
+  .. '</hp:tc>'
+
 local function render_cell_content(cell_blocks, cell_width)
   if not cell_blocks or #cell_blocks == 0 then
     return make_paragraph_xml('')
@@ -846,12 +1049,9 @@ local function render_cell_content(cell_blocks, cell_width)
       local runs_xml, plain_text = process_inlines(block.content, '0')
       local lineseg = compute_lineseg_xml(plain_text, CHAR_HEIGHT_NORMAL, cell_width)
       local pid = next_para_id()
-      cell_parts[#cell_parts+1] = '<hp:p id="' .. pid .. '" paraPrIDRef="0" styleIDRef="0"'
-        .. ' pageBreak="0" columnBreak="0" merged="0">'
-        .. runs_xml .. lineseg .. '</hp:p>'
+      cell_parts[#cell_parts+1] = PARA_XML:format(pid, '0', '0', runs_xml, lineseg)
     else
-      local sub = process_blocks({block}, 0)
-      for _, s in ipairs(sub) do cell_parts[#cell_parts+1] = s end
+      process_blocks({block}, 0, cell_parts)
     end
   end
   if #cell_parts == 0 then return make_paragraph_xml('') end
@@ -902,23 +1102,17 @@ local function parse_openxml_table(xml_str)
   local col_width = math.floor(page_width / col_cnt)
 
   local parts = {}
-  parts[#parts+1] = string.format(
-    '<hp:tbl id="%s" zOrder="0" numberingType="TABLE" textWrap="TOP_AND_BOTTOM"'
-    .. ' textFlow="BOTH_SIDES" lock="0" dropcapstyle="None" pageBreak="CELL"'
-    .. ' repeatHeader="1" rowCnt="%d" colCnt="%d" cellSpacing="0"'
-    .. ' borderFillIDRef="3" noAdjust="0">',
-    tbl_id, row_cnt, col_cnt)
+  parts[#parts+1] = '<hp:tbl id="' .. tbl_id .. TABLE_OPEN_ATTRS
+    .. ' rowCnt="' .. row_cnt .. '" colCnt="' .. col_cnt .. '" cellSpacing="0"'
+    .. ' borderFillIDRef="' .. TABLE_BORDER_FILL_ID .. '" noAdjust="0">'
 
   -- Table structure (matching handle_table format)
   local total_height = 1800 * row_cnt
   parts[#parts+1] = '<hp:sz width="' .. page_width .. '" widthRelTo="ABSOLUTE"'
     .. ' height="' .. total_height .. '" heightRelTo="ABSOLUTE" protect="0"/>'
-  parts[#parts+1] = '<hp:pos treatAsChar="1" affectLSpacing="0" flowWithText="1"'
-    .. ' allowOverlap="0" holdAnchorAndSO="0" vertRelTo="PARA"'
-    .. ' horzRelTo="COLUMN" vertAlign="TOP" horzAlign="CENTER"'
-    .. ' vertOffset="0" horzOffset="0"/>'
-  parts[#parts+1] = '<hp:outMargin left="0" right="0" top="141" bottom="141"/>'
-  parts[#parts+1] = '<hp:inMargin left="0" right="0" top="0" bottom="0"/>'
+  parts[#parts+1] = TABLE_POS_XML
+  parts[#parts+1] = TABLE_OUT_MARGIN_XML
+  parts[#parts+1] = TABLE_IN_MARGIN_XML
 
   -- Build rows
   for ri, row in ipairs(rows) do
@@ -933,30 +1127,21 @@ local function parse_openxml_table(xml_str)
 
       local char_pr = 'charPrIDRef="0"'
       if ri == 1 then
-        local bold_id = get_builtin_char_pr_id(0, {bold = true})
-        char_pr = 'charPrIDRef="' .. bold_id .. '"'
+        char_pr = 'charPrIDRef="' .. get_bold_char_pr_id() .. '"'
       end
 
       local para_id = next_para_id()
       local escaped_text = xml_escape(cell.text)
       local lineseg = compute_lineseg_xml(cell.text, CHAR_HEIGHT_NORMAL, cell_width)
 
-      parts[#parts+1] = '<hp:tc name="" header="' .. header_flag .. '" hasMargin="0"'
-        .. ' protect="0" editable="0" dirty="0" borderFillIDRef="3">'
-        .. '<hp:subList id="' .. sublist_id .. '"'
-        .. ' textDirection="HORIZONTAL" lineWrap="BREAK" vertAlign="CENTER"'
-        .. ' linkListIDRef="0" linkListNextIDRef="0" textWidth="0"'
-        .. ' textHeight="0" hasTextRef="0" hasNumRef="0">'
-        .. '<hp:p id="' .. para_id .. '" paraPrIDRef="0" styleIDRef="0"'
-        .. ' pageBreak="0" columnBreak="0" merged="0">'
-        .. '<hp:run ' .. char_pr .. '><hp:t>' .. escaped_text .. '</hp:t></hp:run>'
-        .. lineseg .. '</hp:p>'
+      parts[#parts+1] = TABLE_CELL_OPEN[header_flag] .. sublist_id .. TABLE_SUBLIST_ATTRS
+        .. PARA_XML:format(para_id, '0', '0',
+             '<hp:run ' .. char_pr .. '><hp:t>' .. escaped_text .. '</hp:t></hp:run>', lineseg)
         .. '</hp:subList>'
         .. '<hp:cellAddr colAddr="' .. col_idx .. '" rowAddr="' .. (ri - 1) .. '"/>'
         .. '<hp:cellSpan colSpan="' .. cell.colspan .. '" rowSpan="1"/>'
         .. '<hp:cellSz width="' .. cell_width .. '" height="1800"/>'
-        .. '<hp:cellMargin left="141" right="141" top="141" bottom="141"/>'
-        .. '</hp:tc>'
+        .. TABLE_CELL_CLOSE
 
       col_idx = col_idx + cell.colspan
     end
@@ -975,46 +1160,46 @@ local function handle_table(block)
   local bodies = block.bodies
   local foot = block.foot
 
-  local all_rows = {}
+  -- Row groups in document order (head, per-body head and body rows,
+  -- foot); rows are walked in place rather than copied into one list
+  local row_groups = {}
   local head_row_count = 0
   if head and head.rows then
-    for _, row in ipairs(head.rows) do
-      all_rows[#all_rows+1] = row
-      head_row_count = head_row_count + 1
-    end
+    row_groups[#row_groups+1] = head.rows
+    head_row_count = #head.rows
   end
   if bodies then
     for _, body in ipairs(bodies) do
-      if body.head then
-        for _, row in ipairs(body.head) do all_rows[#all_rows+1] = row end
-      end
-      if body.body then
-        for _, row in ipairs(body.body) do all_rows[#all_rows+1] = row end
-      end
+      if body.head then row_groups[#row_groups+1] = body.head end
+      if body.body then row_groups[#row_groups+1] = body.body end
     end
   end
-  if foot and foot.rows then
-    for _, row in ipairs(foot.rows) do all_rows[#all_rows+1] = row end
+  if foot and foot.rows then row_groups[#row_groups+1] = foot.rows end
+
+  local row_cnt, first_row = 0, nil
+  for _, rows in ipairs(row_groups) do
+    row_cnt = row_cnt + #rows
+    first_row = first_row or rows[1]
   end
 
-  if #all_rows == 0 then return '' end
+  if row_cnt == 0 then return '' end
 
-  local row_cnt = #all_rows
   local col_cnt = colspecs and #colspecs or 0
-  if col_cnt == 0 and all_rows[1] and all_rows[1].cells then
-    col_cnt = #all_rows[1].cells
+  if col_cnt == 0 and first_row.cells then
+    col_cnt = #first_row.cells
   end
   if col_cnt == 0 then return '' end
 
+  -- Equal split; the leftover (always < col_cnt) widens the first columns
   local col_widths = {}
   local base_w = math.floor(PAGE_TEXT_WIDTH / col_cnt)
-  for i = 1, col_cnt do col_widths[i] = base_w end
   local remainder = PAGE_TEXT_WIDTH - base_w * col_cnt
-  for i = 1, remainder do col_widths[((i-1) % col_cnt) + 1] = col_widths[((i-1) % col_cnt) + 1] + 1 end
+  for i = 1, col_cnt do
+    col_widths[i] = i <= remainder and base_w + 1 or base_w
+  end
 
   local row_height = 1800
   local total_height = row_height * row_cnt
-  local bfid = tostring(TABLE_BORDER_FILL_ID)
 
   local parts = {}
 
@@ -1028,72 +1213,64 @@ local function handle_table(block)
   local pid = next_para_id()
   local tbl_id = unique_id()
 
-  parts[#parts+1] = '<hp:p id="' .. pid .. '" paraPrIDRef="0" styleIDRef="0"'
-    .. ' pageBreak="0" columnBreak="0" merged="0">'
+  parts[#parts+1] = PARA_OPEN_XML:format(pid, '0', '0')
     .. '<hp:run charPrIDRef="0">'
-    .. '<hp:tbl id="' .. tbl_id .. '" zOrder="0" numberingType="TABLE"'
-    .. ' textWrap="TOP_AND_BOTTOM" textFlow="BOTH_SIDES" lock="0"'
-    .. ' dropcapstyle="None" pageBreak="CELL" repeatHeader="1"'
+    .. '<hp:tbl id="' .. tbl_id .. TABLE_OPEN_ATTRS
     .. ' rowCnt="' .. row_cnt .. '" colCnt="' .. col_cnt .. '"'
-    .. ' cellSpacing="0" borderFillIDRef="' .. bfid .. '" noAdjust="0">'
+    .. ' cellSpacing="0" borderFillIDRef="' .. TABLE_BORDER_FILL_ID .. '" noAdjust="0">'
     .. '<hp:sz width="' .. PAGE_TEXT_WIDTH .. '" widthRelTo="ABSOLUTE"'
     .. ' height="' .. total_height .. '" heightRelTo="ABSOLUTE" protect="0"/>'
-    .. '<hp:pos treatAsChar="1" affectLSpacing="0" flowWithText="1"'
-    .. ' allowOverlap="0" holdAnchorAndSO="0" vertRelTo="PARA"'
-    .. ' horzRelTo="COLUMN" vertAlign="TOP" horzAlign="CENTER"'
-    .. ' vertOffset="0" horzOffset="0"/>'
-    .. '<hp:outMargin left="0" right="0" top="141" bottom="141"/>'
-    .. '<hp:inMargin left="0" right="0" top="0" bottom="0"/>'
+    .. TABLE_LAYOUT_XML
 
+  -- Grid slots already covered by a row/col span, keyed row*col_cnt+col
+  -- (spans past the last column are clipped so rows never alias)
   local occupied = {}
-  local function is_occupied(r, c) return occupied[r .. ',' .. c] end
-  local function mark_occupied(r, c) occupied[r .. ',' .. c] = true end
 
-  for row_idx, row in ipairs(all_rows) do
-    local curr_row = row_idx - 1
-    parts[#parts+1] = '<hp:tr>'
-    local curr_col = 0
-    local cells = row.cells or {}
-    for _, cell in ipairs(cells) do
-      while is_occupied(curr_row, curr_col) do curr_col = curr_col + 1 end
-      local actual_col = curr_col
-      local rowspan = cell.row_span or 1
-      local colspan = cell.col_span or 1
-      local cell_blocks = cell.contents or {}
-
-      for r = 0, rowspan-1 do
-        for c = 0, colspan-1 do
-          mark_occupied(curr_row + r, actual_col + c)
+  local curr_row = -1
+  for _, rows in ipairs(row_groups) do
+    for _, row in ipairs(rows) do
+      curr_row = curr_row + 1
+      parts[#parts+1] = '<hp:tr>'
+      local curr_col = 0
+      local cells = row.cells or {}
+      for _, cell in ipairs(cells) do
+        local row_base = curr_row * col_cnt
+        while curr_col < col_cnt and occupied[row_base + curr_col] do
+          curr_col = curr_col + 1
+        end
+        local actual_col = curr_col
+        local rowspan = cell.row_span or 1
+        local colspan = cell.col_span or 1
+        local cell_blocks = cell.contents or {}
+
+        local last_col = math.min(actual_col + colspan, col_cnt) - 1
+        for r = curr_row, curr_row + rowspan - 1 do
+          local base = r * col_cnt
+          for c = actual_col, last_col do occupied[base + c] = true end
         end
-      end
 
-      local cell_width = 0
-      for i = 0, colspan-1 do
-        local idx = actual_col + i + 1
-        cell_width = cell_width + (col_widths[idx] or base_w)
-      end
+        local cell_width = 0
+        for i = 0, colspan-1 do
+          local idx = actual_col + i + 1
+          cell_width = cell_width + (col_widths[idx] or base_w)
+        end
 
-      local header_flag = curr_row < head_row_count and '1' or '0'
-      local cell_content = render_cell_content(cell_blocks, cell_width)
-      local sublist_id = unique_id()
+        local header_flag = curr_row < head_row_count and '1' or '0'
+        local cell_content = render_cell_content(cell_blocks, cell_width)
+        local sublist_id = unique_id()
 
-      parts[#parts+1] = '<hp:tc name="" header="' .. header_flag .. '" hasMargin="0"'
-        .. ' protect="0" editable="0" dirty="0" borderFillIDRef="' .. bfid .. '">'
-        .. '<hp:subList id="' .. sublist_id .. '"'
-        .. ' textDirection="HORIZONTAL" lineWrap="BREAK" vertAlign="CENTER"'
-        .. ' linkListIDRef="0" linkListNextIDRef="0" textWidth="0"'
-        .. ' textHeight="0" hasTextRef="0" hasNumRef="0">'
-        .. cell_content
-        .. '</hp:subList>'
-        .. '<hp:cellAddr colAddr="' .. actual_col .. '" rowAddr="' .. curr_row .. '"/>'
-        .. '<hp:cellSpan colSpan="' .. colspan .. '" rowSpan="' .. rowspan .. '"/>'
-        .. '<hp:cellSz width="' .. cell_width .. '" height="' .. row_height .. '"/>'
-        .. '<hp:cellMargin left="141" right="141" top="141" bottom="141"/>'
-        .. '</hp:tc>'
+        parts[#parts+1] = TABLE_CELL_OPEN[header_flag] .. sublist_id .. TABLE_SUBLIST_ATTRS
+          .. cell_content
+          .. '</hp:subList>'
+          .. '<hp:cellAddr colAddr="' .. actual_col .. '" rowAddr="' .. curr_row .. '"/>'
+          .. '<hp:cellSpan colSpan="' .. colspan .. '" rowSpan="' .. rowspan .. '"/>'
+          .. '<hp:cellSz width="' .. cell_width .. '" height="' .. row_height .. '"/>'
+          .. TABLE_CELL_CLOSE
 
-      curr_col = curr_col + colspan
+        curr_col = curr_col + colspan
+      end
+      parts[#parts+1] = '</hp:tr>'
     end
-    parts[#parts+1] = '</hp:tr>'
   end
 
   parts[#parts+1] = '</hp:tbl>'
@@ -1103,38 +1280,56 @@ end
 
 -- ── Lists ────────────────────────────────────────────────────────────
 
-local function handle_bullet_list(items, indent_level)
-  local depth_index = (list_depth % #BULLET_MARKERS) + 1
-  local marker = BULLET_MARKERS[depth_index]
-  local list_indent = ('\u{3000}'):rep(list_depth)
+-- Marker-prefixed '<hp:t>' tags, memoized per nesting depth (and item
+-- number for ordered lists): every list at a depth reuses the same ones
+local bullet_marker_tags = {}
+local ordered_marker_tags = {}
+
+-- List handlers append item paragraphs to results and then put the
+-- marker into the first paragraph each item added
+local function handle_bullet_list(items, indent_level, results)
+  local tag = bullet_marker_tags[list_depth]
+  if not tag then
+    local marker = BULLET_MARKERS[(list_depth % #BULLET_MARKERS) + 1]
+    tag = '<hp:t>' .. indent_string(list_depth) .. marker .. ' '
+    bullet_marker_tags[list_depth] = tag
+  end
   list_depth = list_depth + 1
-  local results = {}
+  results = results or {}
   for _, item_blocks in ipairs(items) do
-    local item_parts = process_blocks(item_blocks, indent_level)
-    if #item_parts > 0 then
-      item_parts[1] = item_parts[1]:gsub('<hp:t>', '<hp:t>' .. list_indent .. marker .. ' ', 1)
+    local first = #results + 1
+    process_blocks(item_blocks, indent_level, results)
+    if #results >= first then
+      results[first] = results[first]:gsub('<hp:t>', tag, 1)
     end
-    for _, p in ipairs(item_parts) do results[#results+1] = p end
   end
   list_depth = list_depth - 1
   return results
 end
 
-local function handle_ordered_list(block, indent_level)
+local function handle_ordered_list(block, indent_level, results)
   local start_num = block.listAttributes and block.listAttributes.start or 1
-  local depth_index = (list_depth % #ORDERED_FORMATTERS) + 1
-  local formatter = ORDERED_FORMATTERS[depth_index]
-  local list_indent = ('\u{3000}'):rep(list_depth)
+  local formatter = ORDERED_FORMATTERS[(list_depth % #ORDERED_FORMATTERS) + 1]
+  local list_indent = indent_string(list_depth)
+  local tags = ordered_marker_tags[list_depth]
+  if not tags then
+    tags = {}
+    ordered_marker_tags[list_depth] = tags
+  end
   list_depth = list_depth + 1
-  local results = {}
+  results = results or {}
   for idx, item_blocks in ipairs(block.content) do
-    local item_parts = process_blocks(item_blocks, indent_level)
-    if #item_parts > 0 then
+    local first = #results + 1
+    process_blocks(item_blocks, indent_level, results)
+    if #results >= first then
       local num = start_num + idx - 1
-      local prefix = formatter(num)
-      item_parts[1] = item_parts[1]:gsub('<hp:t>', '<hp:t>' .. list_indent .. prefix .. ' ', 1)
+      local tag = tags[num]
+      if not tag then
+        tag = '<hp:t>' .. list_indent .. formatter(num) .. ' '
+        tags[num] = tag
+      end
+      results[first] = results[first]:gsub('<hp:t>', tag, 1)
     end
-    for _, p in ipairs(item_parts) do results[#results+1] = p end
   end
   list_depth = list_depth - 1
   return results
@@ -1142,62 +1337,39 @@ end
 
 -- ── Callout handler ──────────────────────────────────────────────────
 
-local function handle_callout(block, indent_level)
-  -- Determine callout type from classes
-  local callout_type = nil
-  local classes = block.classes or (block.attr and block.attr.classes) or {}
-  for _, cls in ipairs(classes) do
-    local ctype = cls:match('^callout%-(%w+)$')
-    if ctype and CALLOUT_STYLES[ctype] then
-      callout_type = ctype
-      break
-    end
-  end
-  if not callout_type then return nil end
-
-  local style = CALLOUT_STYLES[callout_type]
-  callout_used_types[callout_type] = true
-
-  -- Extract title and body from callout structure
-  local title_text = style.title
-  local body_blocks = {}
-
-  for _, child in ipairs(block.content) do
-    if child.t == 'Div' then
-      local child_classes = child.classes or (child.attr and child.attr.classes) or {}
-      local handled = false
-      for _, cls in ipairs(child_classes) do
-        if cls == 'callout-header' then
-          -- Extract title from header Div
-          local header_text = pandoc.utils.stringify(child.content)
-          if header_text ~= '' then title_text = header_text end
-          handled = true
-          break
-        elseif cls == 'callout-body-container' or cls == 'callout-body' then
-          for _, b in ipairs(child.content) do body_blocks[#body_blocks+1] = b end
-          handled = true
-          break
+-- Callout types in source order, parsed on the first Quarto custom Callout
+-- so documents without callouts never read the source file
+local function source_callout_types()
+  if callout_types_from_source then return callout_types_from_source end
+  callout_types_from_source = {}
+  for _, src_path in ipairs(callout_source_candidates) do
+    local src_content = read_file(src_path)
+    -- Plain find first: most documents have no callouts at all
+    if src_content and src_content:find('.callout-', 1, true) then
+      for ctype in src_content:gmatch('::: *{%.callout%-(%w+)') do
+        if CALLOUT_STYLES[ctype] then
+          callout_types_from_source[#callout_types_from_source+1] = ctype
         end
       end
-      if not handled then
-        body_blocks[#body_blocks+1] = child
+      if #callout_types_from_source > 0 then
+        io.stderr:write('[hwpx] Detected ' .. #callout_types_from_source
+          .. ' callout types from source: '
+          .. table.concat(callout_types_from_source, ', ') .. '\n')
+        break
       end
-    else
-      body_blocks[#body_blocks+1] = child
     end
   end
+  return callout_types_from_source
+end
 
-  if #body_blocks == 0 then
-    body_blocks = block.content
-  end
-
+-- 1-cell table with colored left border and background, shared by the
+-- class-based (.callout-*) and Quarto custom-type callout paths
+local function build_callout_xml(style, title_text, body_blocks)
   -- Build cell content: title (bold) + body
   local cell_parts = {}
-  local bold_id = get_builtin_char_pr_id('0', {BOLD=true})
-  cell_parts[#cell_parts+1] = make_paragraph_xml(title_text, bold_id)
+  cell_parts[#cell_parts+1] = make_paragraph_xml(title_text, get_bold_char_pr_id())
 
-  local body_xml_parts = process_blocks(body_blocks, 0)
-  for _, p in ipairs(body_xml_parts) do cell_parts[#cell_parts+1] = p end
+  process_blocks(body_blocks, 0, cell_parts)
 
   local cell_content = table.concat(cell_parts, '\n')
 
@@ -1208,8 +1380,7 @@ local function handle_callout(block, indent_level)
   local pid = next_para_id()
   local w = PAGE_TEXT_WIDTH
 
-  return '<hp:p id="' .. pid .. '" paraPrIDRef="0" styleIDRef="0"'
-    .. ' pageBreak="0" columnBreak="0" merged="0">'
+  return PARA_OPEN_XML:format(pid, '0', '0')
     .. '<hp:run charPrIDRef="0">'
     .. '<hp:tbl id="' .. tbl_id .. '" zOrder="0" numberingType="TABLE"'
     .. ' textWrap="TOP_AND_BOTTOM" textFlow="BOTH_SIDES" lock="0"'
@@ -1247,71 +1418,133 @@ local function handle_callout(block, indent_level)
     .. '<hp:t></hp:t></hp:run></hp:p>'
 end
 
+local function handle_callout(block, indent_level)
+  -- Determine callout type from classes
+  local callout_type = nil
+  local classes = block.classes or (block.attr and block.attr.classes) or {}
+  for _, cls in ipairs(classes) do
+    local ctype = cls:match('^callout%-(%w+)$')
+    if ctype and CALLOUT_STYLES[ctype] then
+      callout_type = ctype
+      break
+    end
+  end
+  if not callout_type then return nil end
+
+  local style = CALLOUT_STYLES[callout_type]
+  callout_used_types[callout_type] = true
+
+  -- Extract title and body from callout structure
+  local title_text = style.title
+  local body_blocks = {}
+
+  for _, child in ipairs(block.content) do
+    if child.t == 'Div' then
+      local child_classes = child.classes or (child.attr and child.attr.classes) or {}
+      local handled = false
+      for _, cls in ipairs(child_classes) do
+        if cls == 'callout-header' then
+          -- Extract title from header Div
+          local header_text = pandoc.utils.stringify(child.content)
+          if header_text ~= '' then title_text = header_text end
+          handled = true
+          break
+        elseif cls == 'callout-body-container' or cls == 'callout-body' then
+          for _, b in ipairs(child.content) do body_blocks[#body_blocks+1] = b end
+          handled = true
+          break
+        end
+      end
+      if not handled then
+        body_blocks[#body_blocks+1] = child
+      end
+    else
+      body_blocks[#body_blocks+1] = child
+    end
+  end
+
+  if #body_blocks == 0 then
+    body_blocks = block.content
+  end
+
+  return build_callout_xml(style, title_text, body_blocks)
+end
+
 -- ── Main block processor ─────────────────────────────────────────────
 
-process_blocks = function(blocks, indent_level)
-  indent_level = indent_level or 0
-  local indent_prefix = ('\u{3000}'):rep(indent_level)
-  local xml_parts = {}
+-- Push blocks onto a work stack (last block first) with their indent level
+local function push_blocks(stack, levels, blocks, level)
+  for i = #blocks, 1, -1 do
+    stack[#stack+1] = blocks[i]
+    levels[#levels+1] = level
+  end
+end
 
-  for _, block in ipairs(blocks) do
+-- Appends paragraph XML for blocks to xml_parts (a new list if omitted)
+-- and returns it, so nested containers write into their parent's list
+process_blocks = function(blocks, indent_level, xml_parts)
+  xml_parts = xml_parts or {}
+  -- Pure containers (BlockQuote, passthrough Divs) push their children onto
+  -- this work stack instead of recursing; the top of the stack is next
+  local stack, levels = {}, {}
+  push_blocks(stack, levels, blocks, indent_level or 0)
+  local prefix_level, indent_prefix = 0, ''
+
+  while #stack > 0 do
+    local n = #stack
+    local block, level = stack[n], levels[n]
+    stack[n] = nil
+    levels[n] = nil
+    if level ~= prefix_level then
+      prefix_level, indent_prefix = level, indent_string(level)
+    end
     local t = block.t
 
     if t == 'Para' or t == 'Plain' then
-      local pp = handle_para_or_plain(block.content, indent_prefix)
-      for _, p in ipairs(pp) do xml_parts[#xml_parts+1] = p end
+      handle_para_or_plain(block.content, indent_prefix, xml_parts)
 
     elseif t == 'Header' then
       xml_parts[#xml_parts+1] = handle_header(block)
 
     elseif t == 'CodeBlock' then
-      local pp = handle_code_block(block, indent_prefix)
-      for _, p in ipairs(pp) do xml_parts[#xml_parts+1] = p end
+      handle_code_block(block, indent_prefix, xml_parts)
 
     elseif t == 'BulletList' then
-      local pp = handle_bullet_list(block.content, indent_level)
-      for _, p in ipairs(pp) do xml_parts[#xml_parts+1] = p end
+      handle_bullet_list(block.content, level, xml_parts)
 
     elseif t == 'OrderedList' then
-      local pp = handle_ordered_list(block, indent_level)
-      for _, p in ipairs(pp) do xml_parts[#xml_parts+1] = p end
+      handle_ordered_list(block, level, xml_parts)
 
     elseif t == 'BlockQuote' then
-      local pp = process_blocks(block.content, indent_level + 1)
-      for _, p in ipairs(pp) do xml_parts[#xml_parts+1] = p end
+      push_blocks(stack, levels, block.content, level + 1)
 
     elseif t == 'Table' then
       xml_parts[#xml_parts+1] = handle_table(block)
 
     elseif t == 'HorizontalRule' then
-      xml_parts[#xml_parts+1] = make_paragraph_xml(('\u{2501}'):rep(30))
+      xml_parts[#xml_parts+1] = make_hr_paragraph_xml()
 
     elseif t == 'Div' then
       local classes = block.classes or (block.attr and block.attr.classes) or {}
       local attrs = block.attr and block.attr.attributes or {}
       local custom_type = attrs['__quarto_custom_type']
 
-      -- Check for callout (standard class-based, e.g. .callout-note)
-      local is_callout = false
+      -- One pass over the classes: standard class-based callout
+      -- (e.g. .callout-note) and code-fold cell-code
+      local is_callout, is_cell_code = false, false
       for _, cls in ipairs(classes) do
-        local ctype = cls:match('^callout%-(%w+)$')
-        if ctype and CALLOUT_STYLES[ctype] then
+        if CALLOUT_CLASSES[cls] then
           is_callout = true
-          break
+        elseif cls == 'cell-code' then
+          is_cell_code = true
         end
       end
 
-      -- Check for code-fold cell-code
-      local is_cell_code = false
-      for _, cls in ipairs(classes) do
-        if cls == 'cell-code' then is_cell_code = true; break end
-      end
-
       if custom_type == 'Callout' then
         -- Quarto custom Callout: type info lost in custom type conversion
-        -- Recover type from source file parsing (callout_types_from_source)
+        -- Recover type from source file parsing (source_callout_types)
         callout_index = callout_index + 1
-        local detected_type = callout_types_from_source[callout_index] or 'note'
+        local detected_type = source_callout_types()[callout_index] or 'note'
 
         -- Extract body from scaffold[2]
         local body_blocks = {}
@@ -1332,77 +1565,19 @@ process_blocks = function(blocks, indent_level)
 
         callout_used_types[detected_type] = true
         local style = CALLOUT_STYLES[detected_type]
-        local bf_id = tostring(style.border_fill_id)
-
-        -- Build cell content: title (bold) + body from scaffolds
-        local cell_parts = {}
-        local bold_id = get_builtin_char_pr_id('0', {BOLD=true})
-        cell_parts[#cell_parts+1] = make_paragraph_xml(style.title, bold_id)
-
-        if #body_blocks > 0 then
-          local body_xml_parts = process_blocks(body_blocks, 0)
-          for _, p in ipairs(body_xml_parts) do cell_parts[#cell_parts+1] = p end
-        end
-
-        local cell_content = table.concat(cell_parts, '\n')
-
-        -- Build 1-cell callout table
-        local tbl_id = unique_id()
-        local sublist_id = unique_id()
-        local pid = next_para_id()
-        local w = PAGE_TEXT_WIDTH
-
-        xml_parts[#xml_parts+1] = '<hp:p id="' .. pid .. '" paraPrIDRef="0" styleIDRef="0"'
-          .. ' pageBreak="0" columnBreak="0" merged="0">'
-          .. '<hp:run charPrIDRef="0">'
-          .. '<hp:tbl id="' .. tbl_id .. '" zOrder="0" numberingType="TABLE"'
-          .. ' textWrap="TOP_AND_BOTTOM" textFlow="BOTH_SIDES" lock="0"'
-          .. ' dropcapstyle="None" pageBreak="CELL" repeatHeader="0"'
-          .. ' rowCnt="1" colCnt="1"'
-          .. ' cellSpacing="0" borderFillIDRef="' .. bf_id .. '" noAdjust="0">'
-          .. '<hp:sz width="' .. w .. '" widthRelTo="ABSOLUTE"'
-          .. ' height="1800" heightRelTo="ABSOLUTE" protect="0"/>'
-          .. '<hp:pos treatAsChar="1" affectLSpacing="0" flowWithText="1"'
-          .. ' allowOverlap="0" holdAnchorAndSO="0" vertRelTo="PARA"'
-          .. ' horzRelTo="COLUMN" vertAlign="TOP" horzAlign="CENTER"'
-          .. ' vertOffset="0" horzOffset="0"/>'
-          .. '<hp:outMargin left="0" right="0" top="141" bottom="141"/>'
-          .. '<hp:inMargin left="0" right="0" top="0" bottom="0"/>'
-          .. '<hp:tr>'
-          .. '<hp:tc name="" header="0" hasMargin="1"'
-          .. ' protect="0" editable="0" dirty="0" borderFillIDRef="' .. bf_id .. '">'
-          .. '<hp:cellAddr colAddr="0" rowAddr="0"/>'
-          .. '<hp:cellSpan colSpan="1" rowSpan="1"/>'
-          .. '<hp:cellSz width="42520" height="0" sizeType="AT_LEAST"/>'
-          .. '<hp:cellMargin left="1134" right="567" top="283" bottom="283"/>'
-          .. '<hp:subList id="' .. sublist_id .. '"'
-          .. ' textDirection="HORIZONTAL" lineWrap="BREAK" vertAlign="TOP"'
-          .. ' linkListIDRef="0" linkListNextIDRef="0" textWidth="0"'
-          .. ' textHeight="0" hasTextRef="0" hasNumRef="0">'
-          .. cell_content
-          .. '</hp:subList>'
-          .. '<hp:cellAddr colAddr="0" rowAddr="0"/>'
-          .. '<hp:cellSpan colSpan="1" rowSpan="1"/>'
-          .. '<hp:cellSz width="' .. w .. '" height="1800"/>'
-          .. '<hp:cellMargin left="1134" right="567" top="283" bottom="283"/>'
-          .. '</hp:tc>'
-          .. '</hp:tr>'
-          .. '</hp:tbl>'
-          .. '<hp:t></hp:t></hp:run></hp:p>'
+        xml_parts[#xml_parts+1] = build_callout_xml(style, style.title, body_blocks)
 
       elseif custom_type == 'FloatRefTarget' then
         -- Quarto figure/table float: pass through content (caption included in scaffolds)
-        local pp = process_blocks(block.content, indent_level)
-        for _, p in ipairs(pp) do xml_parts[#xml_parts+1] = p end
+        push_blocks(stack, levels, block.content, level)
 
       elseif is_callout then
         -- Standard class-based callout (e.g. .callout-note)
-        local callout_xml = handle_callout(block, indent_level)
+        local callout_xml = handle_callout(block, level)
         if callout_xml then
           xml_parts[#xml_parts+1] = callout_xml
         else
-          local pp = process_blocks(block.content, indent_level)
-          for _, p in ipairs(pp) do xml_parts[#xml_parts+1] = p end
+          push_blocks(stack, levels, block.content, level)
         end
 
       elseif code_fold_enabled and is_cell_code then
@@ -1410,14 +1585,12 @@ process_blocks = function(blocks, indent_level)
 
       else
         -- Pass-through (including Quarto cell wrappers and scaffolds)
-        local pp = process_blocks(block.content, indent_level)
-        for _, p in ipairs(pp) do xml_parts[#xml_parts+1] = p end
+        push_blocks(stack, levels, block.content, level)
       end
 
     elseif t == 'Figure' then
       -- Native Pandoc Figure block (Pandoc 3.8+, non-Quarto path)
-      local fig_parts = process_blocks(block.content, indent_level)
-      for _, p in ipairs(fig_parts) do xml_parts[#xml_parts+1] = p end
+      process_blocks(block.content, level, xml_parts)
       -- Add caption as italic paragraph
       if block.caption and block.caption.long and #block.caption.long > 0 then
         local cap_text = pandoc.utils.stringify(block.caption.long)
@@ -1432,8 +1605,7 @@ process_blocks = function(blocks, indent_level)
         local term_text = get_plain_text(item[1])
         xml_parts[#xml_parts+1] = make_paragraph_xml(indent_prefix .. term_text)
         for _, def_blocks in ipairs(item[2]) do
-          local pp = process_blocks(def_blocks, indent_level + 1)
-          for _, p in ipairs(pp) do xml_parts[#xml_parts+1] = p end
+          process_blocks(def_blocks, level + 1, xml_parts)
         end
       end
 
@@ -1449,8 +1621,7 @@ process_blocks = function(blocks, indent_level)
       if tbl_xml then
         -- Wrap in <hp:p><hp:run> — required for 한글 to render the table
         local pid = next_para_id()
-        xml_parts[#xml_parts+1] = '<hp:p id="' .. pid .. '" paraPrIDRef="0" styleIDRef="0"'
-          .. ' pageBreak="0" columnBreak="0" merged="0">'
+        xml_parts[#xml_parts+1] = PARA_OPEN_XML:format(pid, '0', '0')
           .. '<hp:run charPrIDRef="0">'
           .. tbl_xml
           .. '<hp:t></hp:t></hp:run></hp:p>'
@@ -1460,8 +1631,7 @@ process_blocks = function(blocks, indent_level)
       -- Parse HTML tables via pandoc.read
       local ok, parsed = pcall(pandoc.read, block.text, 'html')
       if ok and parsed then
-        local sub = process_blocks(parsed.blocks, indent_level)
-        for _, p in ipairs(sub) do xml_parts[#xml_parts+1] = p end
+        push_blocks(stack, levels, parsed.blocks, level)
       end
 
     -- Other RawBlock: skip
@@ -1484,68 +1654,81 @@ local function extract_metadata(doc)
   return title, subtitle, author, date_str
 end
 
-local function build_title_block(title, subtitle, author, date_str)
-  local parts = {}
-  if title ~= '' then
-    parts[#parts+1] = make_paragraph_xml(title, '7')
-  end
-  if subtitle ~= '' then
-    parts[#parts+1] = make_paragraph_xml(subtitle, '8')
-  end
-  if author ~= '' or date_str ~= '' then
-    local meta_parts = {}
-    if author ~= '' then meta_parts[#meta_parts+1] = author end
-    if date_str ~= '' then meta_parts[#meta_parts+1] = date_str end
-    parts[#parts+1] = make_paragraph_xml(table.concat(meta_parts, ' | '))
+-- Boolean option from metadata: YAML booleans arrive as plain Lua booleans,
+-- anything else (e.g. a quoted "true") falls back to stringify
+local function meta_flag(meta, key)
+  local v = meta and meta[key]
+  if v == nil then return false end
+  if type(v) == 'boolean' then return v end
+  return pandoc.utils.stringify(v) == 'true'
+end
+
+local function build_title_block(title, subtitle, author, date_str, parts)
+  parts = parts or {}
+  local first = #parts + 1
+  local byline = {}
+  if author ~= '' then byline[#byline+1] = author end
+  if date_str ~= '' then byline[#byline+1] = date_str end
+  -- {text, char_pr_id} per title line; empty lines are left out
+  local lines = {
+    {title, '7'},
+    {subtitle, '8'},
+    {table.concat(byline, ' | '), '0'},
+  }
+  for _, line in ipairs(lines) do
+    if line[1] ~= '' then
+      parts[#parts+1] = make_paragraph_xml(line[1], line[2])
+    end
   end
-  if #parts > 0 then
+  if #parts >= first then
     parts[#parts+1] = make_paragraph_xml('')
   end
   return parts
 end
 
+-- Headings in document order; headings.min_level is tracked while collecting
 local function collect_headings(blocks)
-  local headings = {}
-  for _, block in ipairs(blocks) do
+  local headings = {min_level = 999}
+  -- Depth-first over nested Divs with an explicit stack instead of recursion
+  local stack = {}
+  push_reversed(stack, blocks)
+  while #stack > 0 do
+    local block = stack[#stack]
+    stack[#stack] = nil
     if block.t == 'Header' then
       headings[#headings+1] = {
         level = block.level,
         text = get_plain_text(block.content),
       }
+      if block.level < headings.min_level then headings.min_level = block.level end
     elseif block.t == 'Div' then
-      local sub = collect_headings(block.content)
-      for _, h in ipairs(sub) do headings[#headings+1] = h end
+      push_reversed(stack, block.content)
     end
   end
   return headings
 end
 
-local function build_toc_block(blocks)
+local function build_toc_block(blocks, parts)
+  parts = parts or {}
   local headings = collect_headings(blocks)
-  if #headings == 0 then return {} end
+  if #headings == 0 then return parts end
 
-  local parts = {}
   parts[#parts+1] = make_paragraph_xml('\u{BAA9}  \u{CC28}', '8')
   parts[#parts+1] = make_paragraph_xml('')
 
-  local min_level = 999
-  for _, h in ipairs(headings) do
-    if h.level < min_level then min_level = h.level end
-  end
-
+  local min_level = headings.min_level
   for _, h in ipairs(headings) do
     local relative = h.level - min_level
-    local indent = ('\u{3000}'):rep(relative * 2)
+    local indent = indent_string(relative * 2)
     if relative == 0 then
-      local bold_id = get_builtin_char_pr_id('0', {BOLD=true})
-      parts[#parts+1] = make_paragraph_xml(indent .. h.text, bold_id)
+      parts[#parts+1] = make_paragraph_xml(indent .. h.text, get_bold_char_pr_id())
     else
       parts[#parts+1] = make_paragraph_xml(indent .. h.text)
     end
   end
 
   parts[#parts+1] = make_paragraph_xml('')
-  parts[#parts+1] = make_paragraph_xml(('\u{2501}'):rep(30))
+  parts[#parts+1] = make_hr_paragraph_xml()
   parts[#parts+1] = make_paragraph_xml('')
   return parts
 end
@@ -1554,98 +1737,163 @@ end
 -- PART 15: XML Assembly
 -- ══════════════════════════════════════════════════════════════════════
 
-local function build_section_xml(original, body_xml)
-  local sec_start = original:find('<hs:sec')
-  local sec_end = original:find('>', sec_start)
+-- Header/content.hpf patterns, built once at load
+local FONTFACE_PATTERN = '<hh:fontface lang="%w+"[^>]*>.-</hh:fontface>'
+local CHAR_PROPERTIES_CNT_PATTERN = '(<hh:charProperties%s+itemCnt=")(%d+)"'
+local BORDER_FILLS_CNT_PATTERN = '(<hh:borderFills%s+itemCnt=")(%d+)"'
+local PARA_PROPERTIES_CNT_PATTERN = '(<hh:paraProperties%s+itemCnt=")(%d+)"'
+local PREV_ZERO_PATTERN = '<hc:prev%s+value="0"'
+
+-- Heading paraPr lookups with their replacement top margins
+local HEADING_SPACING_PATCHES = {}
+for para_pr_id, prev_val in pairs(HEADING_SPACING) do
+  HEADING_SPACING_PATCHES[#HEADING_SPACING_PATCHES+1] = {
+    tag = '<hh:paraPr%s+id="' .. para_pr_id .. '"',
+    prev = '<hc:prev value="' .. prev_val .. '"',
+  }
+end
+
+local OPF_TITLE_PATTERN = '(<opf:title)(/?>.-</opf:title>)'
+-- Manifest media types by stored image extension (default image/png)
+local IMAGE_MIME = { jpg = 'image/jpeg', gif = 'image/gif', png = 'image/png' }
+
+local OPF_META_PATTERN = '(<opf:meta name="([^"]+)" content="text")>.-</opf:meta>'
+
+-- Apply non-overlapping {first, last, text} edits to s in one pass;
+-- an insertion at position i is {i, i - 1, text}
+local function splice_edits(s, edits)
+  table.sort(edits, function(a, b) return a[1] < b[1] end)
+  local parts, pos = {}, 1
+  for _, e in ipairs(edits) do
+    parts[#parts+1] = s:sub(pos, e[1] - 1)
+    parts[#parts+1] = e[3]
+    pos = e[2] + 1
+  end
+  parts[#parts+1] = s:sub(pos)
+  return table.concat(parts)
+end
+
+-- Edit setting the itemCnt value matched by a *_CNT_PATTERN; count may
+-- be a function of the current value
+local function item_count_edit(xml, pattern, count)
+  local s, _, pre, cnt = xml:find(pattern)
+  if not s then return nil end
+  if type(count) == 'function' then count = count(tonumber(cnt)) end
+  local first = s + #pre
+  return {first, first + #cnt - 1, tostring(count)}
+end
+
+-- Split the section template once when it is loaded: everything kept
+-- ahead of the body (XML declaration, <hs:sec> open tag and the first
+-- paragraph, which carries the page setup)
+local function section_template_prefix(original)
+  local sec_start = original:find('<hs:sec', 1, true)
+  local sec_end = original:find('>', sec_start, true)
   local header_and_open = original:sub(1, sec_end)
 
-  local p_start = original:find('<hp:p ')
-  local _, p_end = original:find('</hp:p>')
+  local p_start = original:find('<hp:p ', 1, true)
+  local _, p_end = original:find('</hp:p>', 1, true)
   local first_paragraph = original:sub(p_start, p_end)
 
-  return header_and_open .. first_paragraph .. '\n' .. body_xml .. '\n</hs:sec>'
+  return header_and_open .. first_paragraph .. '\n'
 end
 
+local function build_section_xml(prefix, body_xml)
+  return prefix .. body_xml .. '\n</hs:sec>'
+end
+
+-- Replacement fontface blocks depend only on the language: build each
+-- once, sharing the constant D2Coding entry
+local CODE_FONT_XML = make_font_xml(2, 'D2Coding')
+local fontface_blocks = {}
+
 local function replace_fontface_block(match_text)
   local lang = match_text:match('lang="(%w+)"')
-  local primary_font = LANG_FONT_MAP[lang] or 'NimbusSanL'
-  return '<hh:fontface lang="' .. lang .. '" fontCnt="3">'
-    .. make_font_xml(0, primary_font)
-    .. make_font_xml(1, primary_font)
-    .. make_font_xml(2, 'D2Coding')
-    .. '</hh:fontface>'
+  local block = fontface_blocks[lang]
+  if not block then
+    local primary_font = LANG_FONT_MAP[lang] or 'NimbusSanL'
+    block = '<hh:fontface lang="' .. lang .. '" fontCnt="3">'
+      .. make_font_xml(0, primary_font)
+      .. make_font_xml(1, primary_font)
+      .. CODE_FONT_XML
+      .. '</hh:fontface>'
+    fontface_blocks[lang] = block
+  end
+  return block
 end
 
 local function update_header_xml(header_xml)
   -- Replace fontface blocks
-  header_xml = header_xml:gsub(
-    '<hh:fontface lang="%w+"[^>]*>.-</hh:fontface>',
-    replace_fontface_block)
+  header_xml = header_xml:gsub(FONTFACE_PATTERN, replace_fontface_block)
 
   -- Add heading charPr entries
-  local new_charpr = ''
+  local new_charpr = {}
   for _, cp in ipairs(HEADING_CHAR_PROPS) do
-    new_charpr = new_charpr .. make_charpr_xml(cp.id, cp.height, {bold=cp.bold, font_ref=cp.font_ref})
+    new_charpr[#new_charpr+1] = make_charpr_xml(cp.id, cp.height, {bold=cp.bold, font_ref=cp.font_ref})
   end
 
   -- Code charPr
-  new_charpr = new_charpr .. make_charpr_xml(CODE_CHAR_PR_ID, 1000, {font_ref=CODE_FONT_REF})
+  new_charpr[#new_charpr+1] = make_charpr_xml(CODE_CHAR_PR_ID, 1000, {font_ref=CODE_FONT_REF})
 
   -- Caption charPr (9pt italic)
-  new_charpr = new_charpr .. make_charpr_xml(CAPTION_CHAR_PR_ID, CAPTION_CHAR_HEIGHT, {italic=true, font_ref=0})
+  new_charpr[#new_charpr+1] = make_charpr_xml(CAPTION_CHAR_PR_ID, CAPTION_CHAR_HEIGHT, {italic=true, font_ref=0})
 
   -- Dynamic format charPr entries
-  for _, entry in pairs(char_pr_cache) do
-    local base_id = tonumber(entry.base_id) or 0
-    local base_height = CHAR_HEIGHT_MAP[base_id] or 1000
-    local base_font_ref = (base_id == CODE_CHAR_PR_ID) and CODE_FONT_REF or 0
+  for _, entry in ipairs(char_pr_entries) do
+    local base = BASE_ID_INFO[entry.base_id] or DEFAULT_BASE_INFO
     local fmts = entry.formats
-    new_charpr = new_charpr .. make_charpr_xml(tonumber(entry.id), base_height, {
-      bold = fmts['BOLD'] or (base_id == 7) or (base_id == 8),
-      italic = fmts['ITALIC'],
-      underline = fmts['UNDERLINE'],
-      strikeout = fmts['STRIKEOUT'],
-      text_color = fmts['COLOR_BLUE'] and '#0000FF' or nil,
-      font_ref = base_font_ref,
+    new_charpr[#new_charpr+1] = make_charpr_xml(entry.id, base.height, {
+      bold = (fmts & FMT_BOLD ~= 0) or base.bold,
+      italic = fmts & FMT_ITALIC ~= 0,
+      underline = fmts & FMT_UNDERLINE ~= 0,
+      strikeout = fmts & FMT_STRIKEOUT ~= 0,
+      text_color = (fmts & FMT_COLOR_BLUE ~= 0) and '#0000FF' or nil,
+      font_ref = base.font_ref,
     })
   end
 
-  header_xml = header_xml:gsub('</hh:charProperties>', new_charpr .. '</hh:charProperties>')
+  -- The remaining changes are located on the fontface-updated header and
+  -- spliced in together, so the document is copied only once more
+  local edits = {}
+  local function add_edit(edit)
+    if edit then edits[#edits+1] = edit end
+  end
+  local function insert_before(close_tag, text)
+    local pos = header_xml:find(close_tag, 1, true)
+    if pos then edits[#edits+1] = {pos, pos - 1, text} end
+    return pos
+  end
+
+  insert_before('</hh:charProperties>', table.concat(new_charpr))
 
-  -- Update itemCnt
-  local cache_count = 0
-  for _ in pairs(char_pr_cache) do cache_count = cache_count + 1 end
+  -- Update itemCnt: dynamic ids are allocated consecutively after the
+  -- caption charPr, so the running max id already counts them
+  local cache_count = max_char_pr_id - CAPTION_CHAR_PR_ID
   local total = 7 + #HEADING_CHAR_PROPS + 1 + 1 + cache_count  -- +1 for caption charPr
-  header_xml = header_xml:gsub(
-    '(<hh:charProperties%s+itemCnt=")%d+(")', '%1' .. total .. '%2')
+  add_edit(item_count_edit(header_xml, CHAR_PROPERTIES_CNT_PATTERN, total))
 
   -- Table borderFill
-  local extra_bf = make_table_borderfill_xml()
+  local extra_bf = TABLE_BORDER_FILL_XML
+  local bf_count = 3  -- 2 template + 1 table
 
-  -- Callout borderFills
+  -- Callout borderFills, counted as they are emitted
   for ctype, _ in pairs(callout_used_types) do
     local style = CALLOUT_STYLES[ctype]
     extra_bf = extra_bf .. make_callout_borderfill_xml(style.border_fill_id, style.border_color, style.bg_color)
+    bf_count = bf_count + 1
   end
 
-  header_xml = header_xml:gsub('</hh:borderFills>', extra_bf .. '</hh:borderFills>')
-
-  local bf_count = 3  -- 2 template + 1 table
-  for _ in pairs(callout_used_types) do bf_count = bf_count + 1 end
-  header_xml = header_xml:gsub(
-    '(<hh:borderFills%s+itemCnt=")%d+(")', '%1' .. bf_count .. '%2')
+  insert_before('</hh:borderFills>', extra_bf)
+  add_edit(item_count_edit(header_xml, BORDER_FILLS_CNT_PATTERN, bf_count))
 
   -- Heading spacing (position-based search to handle multiline XML)
-  for para_pr_id, prev_val in pairs(HEADING_SPACING) do
-    local tag = '<hh:paraPr%s+id="' .. para_pr_id .. '"'
-    local s = header_xml:find(tag)
+  for _, patch in ipairs(HEADING_SPACING_PATCHES) do
+    local s = header_xml:find(patch.tag)
     if s then
-      local e = header_xml:find('</hh:paraPr>', s)
+      local _, e = header_xml:find('</hh:paraPr>', s, true)
       if e then
-        local section = header_xml:sub(s, e + 12)
-        local patched = section:gsub(
-          '<hc:prev%s+value="0"', '<hc:prev value="' .. prev_val .. '"')
-        header_xml = header_xml:sub(1, s-1) .. patched .. header_xml:sub(e + 13)
+        local section = header_xml:sub(s, e)
+        edits[#edits+1] = {s, e, (section:gsub(PREV_ZERO_PATTERN, patch.prev))}
       end
     end
   end
@@ -1685,63 +1933,53 @@ local function update_header_xml(header_xml)
     .. '<hh:border borderFillIDRef="2" offsetLeft="0" offsetRight="0"'
     .. ' offsetTop="0" offsetBottom="0" connect="0" ignoreMargin="0"/>'
     .. '</hh:paraPr>'
-  local pp_close = '</hh:paraProperties>'
-  local pp_pos = header_xml:find(pp_close)
-  if pp_pos then
-    header_xml = header_xml:sub(1, pp_pos - 1) .. caption_para_pr .. pp_close .. header_xml:sub(pp_pos + #pp_close)
+  if insert_before('</hh:paraProperties>', caption_para_pr) then
     -- Update paraProperties itemCnt
-    header_xml = header_xml:gsub(
-      '(<hh:paraProperties%s+itemCnt=")(%d+)(")',
-      function(pre, cnt, post)
-        return pre .. (tonumber(cnt) + 1) .. post
-      end)
+    add_edit(item_count_edit(header_xml, PARA_PROPERTIES_CNT_PATTERN,
+      function(cnt) return cnt + 1 end))
   end
 
-  return header_xml
+  return splice_edits(header_xml, edits)
 end
 
 local function update_content_hpf(hpf_xml, title, author, date_str)
   local now = os.date('!%Y-%m-%dT%H:%M:%SZ')
 
+  -- Title values go into gsub replacements: escape '%' as well
   if title ~= '' then
-    hpf_xml = hpf_xml:gsub(
-      '(<opf:title)(/?>.-</opf:title>)',
-      '%1>' .. xml_escape(title) .. '</opf:title>')
-    hpf_xml = hpf_xml:gsub('<opf:title/>', '<opf:title>' .. xml_escape(title) .. '</opf:title>')
+    local safe = escape_repl(xml_escape(title))
+    hpf_xml = hpf_xml:gsub(OPF_TITLE_PATTERN, '%1>' .. safe .. '</opf:title>')
+    hpf_xml = hpf_xml:gsub('<opf:title/>', '<opf:title>' .. safe .. '</opf:title>')
   end
 
+  -- Text metas are rewritten in one pass, dispatching on their name;
+  -- names without a value keep their original element
+  local meta_values = { ModifiedDate = now }
   if author ~= '' then
     local safe = xml_escape(author)
-    hpf_xml = hpf_xml:gsub(
-      '(<opf:meta name="creator" content="text")>.-</opf:meta>',
-      '%1>' .. safe .. '</opf:meta>')
-    hpf_xml = hpf_xml:gsub(
-      '(<opf:meta name="lastsaveby" content="text")>.-</opf:meta>',
-      '%1>' .. safe .. '</opf:meta>')
+    meta_values.creator = safe
+    meta_values.lastsaveby = safe
   end
-
-  hpf_xml = hpf_xml:gsub(
-    '(<opf:meta name="ModifiedDate" content="text")>.-</opf:meta>',
-    '%1>' .. now .. '</opf:meta>')
-
   if date_str ~= '' then
-    hpf_xml = hpf_xml:gsub(
-      '(<opf:meta name="date" content="text")>.-</opf:meta>',
-      '%1>' .. xml_escape(date_str) .. '</opf:meta>')
+    meta_values.date = xml_escape(date_str)
   end
+  hpf_xml = hpf_xml:gsub(OPF_META_PATTERN, function(open, name)
+    local value = meta_values[name]
+    if value then return open .. '>' .. value .. '</opf:meta>' end
+  end)
 
-  -- Add image items to manifest
+  -- Add image items to manifest, spliced in ahead of its closing tag
   if #images > 0 then
-    local new_items = {}
-    for _, img in ipairs(images) do
-      local mime = 'image/png'
-      if img.ext == 'jpg' then mime = 'image/jpeg'
-      elseif img.ext == 'gif' then mime = 'image/gif' end
-      new_items[#new_items+1] = '<opf:item id="' .. img.id .. '" href="BinData/' .. img.id .. '.' .. img.ext .. '"'
-        .. ' media-type="' .. mime .. '" isEmbeded="1"/>'
+    local pos = hpf_xml:find('</opf:manifest>', 1, true)
+    if pos then
+      local parts = {hpf_xml:sub(1, pos - 1)}
+      for _, img in ipairs(images) do
+        parts[#parts+1] = '<opf:item id="' .. img.id .. '" href="BinData/' .. img.id .. '.' .. img.ext .. '"'
+          .. ' media-type="' .. (IMAGE_MIME[img.ext] or 'image/png') .. '" isEmbeded="1"/>\n'
+      end
+      parts[#parts+1] = hpf_xml:sub(pos)
+      hpf_xml = table.concat(parts)
     end
-    local insert_str = table.concat(new_items, '\n') .. '\n'
-    hpf_xml = hpf_xml:gsub('</opf:manifest>', insert_str .. '</opf:manifest>')
   end
 
   return hpf_xml
@@ -1751,39 +1989,46 @@ end
 -- PART 16: ZIP Assembly
 -- ══════════════════════════════════════════════════════════════════════
 
-local function write_hwpx(output_path, section_xml, header_xml, hpf_xml)
+-- Extract the template once into a work directory; the same directory is
+-- read for the template XML and then repacked as the output archive
+local function extract_template()
   local template_path = SCRIPT_DIR .. 'templates/blank.hwpx'
   if not file_exists(template_path) then
     io.stderr:write('[hwpx] ERROR: Template not found: ' .. template_path .. '\n')
-    return false
+    return nil
   end
 
   local tmpdir = os.tmpname() .. '_hwpx'
   os.execute('mkdir -p ' .. shell_escape(tmpdir))
 
-  -- Extract template
   local unzip_cmd = 'unzip -o -q ' .. shell_escape(template_path) .. ' -d ' .. shell_escape(tmpdir)
   local ok = os.execute(unzip_cmd)
   if not ok then
     io.stderr:write('[hwpx] ERROR: Failed to extract template (is unzip installed?)\n')
     os.execute('rm -rf ' .. shell_escape(tmpdir))
-    return false
+    return nil
   end
+  return tmpdir
+end
 
-  -- Write modified XML files
-  write_file(tmpdir .. '/Contents/section0.xml', section_xml)
-  write_file(tmpdir .. '/Contents/header.xml', header_xml)
-  write_file(tmpdir .. '/Contents/content.hpf', hpf_xml)
+local function write_hwpx(output_path, tmpdir, section_xml, header_xml, hpf_xml)
+  -- Write modified XML files; bail out before zipping a half-written package
+  if not (write_file(tmpdir .. '/Contents/section0.xml', section_xml)
+      and write_file(tmpdir .. '/Contents/header.xml', header_xml)
+      and write_file(tmpdir .. '/Contents/content.hpf', hpf_xml)) then
+    io.stderr:write('[hwpx] ERROR: Failed to write package contents in ' .. tmpdir .. '\n')
+    os.execute('rm -rf ' .. shell_escape(tmpdir))
+    return false
+  end
 
   -- Copy images to BinData/
   if #images > 0 then
     os.execute('mkdir -p ' .. shell_escape(tmpdir .. '/BinData'))
     for _, img in ipairs(images) do
       local resolved = img.resolved_path
-      if resolved and file_exists(resolved) then
-        local dest = tmpdir .. '/BinData/' .. img.id .. '.' .. img.ext
-        os.execute('cp ' .. shell_escape(resolved) .. ' ' .. shell_escape(dest))
-      else
+      local dest = tmpdir .. '/BinData/' .. img.id .. '.' .. img.ext
+      -- Copied in-process: one cp subprocess per image adds up on figure-heavy docs
+      if not (resolved and copy_file(resolved, dest)) then
         io.stderr:write('[hwpx] WARNING: Image not found: ' .. (img.path or '?') .. '\n')
       end
     end
@@ -1792,10 +2037,15 @@ local function write_hwpx(output_path, section_xml, header_xml, hpf_xml)
   -- Remove existing HWPX to prevent zip -r from appending to old archive
   os.remove(output_path)
 
-  -- Create HWPX ZIP
-  local zip_cmd = 'cd ' .. shell_escape(tmpdir) .. ' && zip -r -q '
-    .. shell_escape(output_path) .. ' .'
-  ok = os.execute(zip_cmd)
+  -- Create HWPX ZIP: mimetype goes first and stored, as readers sniff it
+  -- at a fixed offset; the rest uses the fastest deflate level since the
+  -- parts are small and mostly text, except already-compressed images,
+  -- which are stored rather than deflated again for no gain
+  local out = shell_escape(output_path)
+  local zip_cmd = 'cd ' .. shell_escape(tmpdir)
+    .. ' && zip -q -0 ' .. out .. ' mimetype'
+    .. ' && zip -r -q -1 -n .png:.jpg:.jpeg:.gif ' .. out .. ' . -x mimetype'
+  local ok = os.execute(zip_cmd)
 
   -- Cleanup
   os.execute('rm -rf ' .. shell_escape(tmpdir))
@@ -1830,101 +2080,86 @@ function Pandoc(doc)
 
   -- Make output path absolute
   if not hwpx_path:match('^/') then
-    local cwd = io.popen('pwd'):read('*l')
-    hwpx_path = cwd .. '/' .. hwpx_path
+    -- Ask pandoc for the working directory instead of spawning pwd
+    hwpx_path = pandoc.system.get_working_directory() .. '/' .. hwpx_path
+  end
+
+  -- Fail fast on an unwritable output path before doing the conversion work
+  local existing = io.open(hwpx_path, 'rb')
+  if existing then existing:close() end
+  local probe = io.open(hwpx_path, 'ab')
+  if not probe then
+    io.stderr:write('[hwpx] ERROR: Cannot write output file ' .. hwpx_path .. '\n')
+    return doc
   end
+  probe:close()
+  if not existing then os.remove(hwpx_path) end
 
   -- Determine input directory
-  input_dir = './'
+  input_dir = ''
   if PANDOC_STATE.input_files and #PANDOC_STATE.input_files > 0 then
-    input_dir = PANDOC_STATE.input_files[1]:match('(.*[/\\])') or './'
+    input_dir = PANDOC_STATE.input_files[1]:match('(.*[/\\])') or ''
   end
 
   -- Detect TOC
-  local has_toc = false
-  if PANDOC_WRITER_OPTIONS and PANDOC_WRITER_OPTIONS.table_of_contents then
-    has_toc = true
-  elseif doc.meta and doc.meta.toc then
-    has_toc = pandoc.utils.stringify(doc.meta.toc) == 'true'
-  end
+  local has_toc = (PANDOC_WRITER_OPTIONS and PANDOC_WRITER_OPTIONS.table_of_contents)
+    or meta_flag(doc.meta, 'toc')
 
   io.stderr:write('[hwpx] Generating ' .. hwpx_path .. ' (pure Lua engine)...\n')
   if has_toc then io.stderr:write('[hwpx] TOC enabled\n') end
 
   -- Detect code-fold
-  if doc.meta and doc.meta['code-fold'] then
-    code_fold_enabled = pandoc.utils.stringify(doc.meta['code-fold']) == 'true'
-  else
-    code_fold_enabled = false
-  end
+  code_fold_enabled = meta_flag(doc.meta, 'code-fold')
 
   -- Reset state for this conversion
   para_id_counter = 3121190098
   max_char_pr_id = CAPTION_CHAR_PR_ID
   char_pr_cache = {}
+  char_pr_entries = {}
   images = {}
+  resolved_image_paths = {}
+  image_dimensions = {}
+  image_counter = 0
+  paragraph_lineseg_cache = {}
+  equation_xml_cache = {}
+  bold_char_pr_id = nil
   callout_used_types = {}
-  callout_types_from_source = {}
+  callout_types_from_source = nil
   callout_index = 0
   list_depth = 0
   math.randomseed(os.time())
 
-  -- Parse callout types from source file (QMD or knit.md)
+  -- Source files (QMD or knit.md) to recover callout types from
   -- Quarto's custom Callout Div loses type info; recover from source syntax
-  local source_candidates = {}
+  callout_source_candidates = {}
   if PANDOC_STATE.input_files and #PANDOC_STATE.input_files > 0 then
-    source_candidates[#source_candidates+1] = PANDOC_STATE.input_files[1]
+    callout_source_candidates[#callout_source_candidates+1] = PANDOC_STATE.input_files[1]
   end
   local base_name = hwpx_path:match('([^/\\]+)%.hwpx$') or ''
   if base_name ~= '' then
-    source_candidates[#source_candidates+1] = input_dir .. base_name .. '.qmd'
-  end
-  for _, src_path in ipairs(source_candidates) do
-    local src_content = read_file(src_path)
-    if src_content then
-      for ctype in src_content:gmatch('::: *{%.callout%-(%w+)') do
-        if CALLOUT_STYLES[ctype] then
-          callout_types_from_source[#callout_types_from_source+1] = ctype
-        end
-      end
-      if #callout_types_from_source > 0 then
-        io.stderr:write('[hwpx] Detected ' .. #callout_types_from_source
-          .. ' callout types from source: '
-          .. table.concat(callout_types_from_source, ', ') .. '\n')
-        break
-      end
-    end
+    callout_source_candidates[#callout_source_candidates+1] = input_dir .. base_name .. '.qmd'
   end
 
   -- Extract metadata
   local title, subtitle, author, date_str = extract_metadata(doc)
 
-  -- Load template XML
-  local template_path = SCRIPT_DIR .. 'templates/blank.hwpx'
-  local tmpdir_tpl = os.tmpname() .. '_tpl'
-  os.execute('mkdir -p ' .. shell_escape(tmpdir_tpl))
-  os.execute('unzip -o -q ' .. shell_escape(template_path) .. ' -d ' .. shell_escape(tmpdir_tpl))
-  local section0_raw = read_file(tmpdir_tpl .. '/Contents/section0.xml') or ''
-  local header_xml_raw = read_file(tmpdir_tpl .. '/Contents/header.xml') or ''
-  local hpf_xml_raw = read_file(tmpdir_tpl .. '/Contents/content.hpf') or ''
-  os.execute('rm -rf ' .. shell_escape(tmpdir_tpl))
+  -- Load template XML (extracted once, reused by write_hwpx)
+  local tmpdir = extract_template()
+  if not tmpdir then return doc end
+  local section_prefix = section_template_prefix(
+    read_file(tmpdir .. '/Contents/section0.xml') or '')
+  local header_xml_raw = read_file(tmpdir .. '/Contents/header.xml') or ''
+  local hpf_xml_raw = read_file(tmpdir .. '/Contents/content.hpf') or ''
 
   -- Build body
   local body_parts = {}
 
-  -- Title block
-  local title_parts = build_title_block(title, subtitle, author, date_str)
-  for _, p in ipairs(title_parts) do body_parts[#body_parts+1] = p end
-
-  -- TOC
+  -- Title block, TOC and content all append into body_parts
+  build_title_block(title, subtitle, author, date_str, body_parts)
   if has_toc then
-    local toc_parts = build_toc_block(doc.blocks)
-    for _, p in ipairs(toc_parts) do body_parts[#body_parts+1] = p end
+    build_toc_block(doc.blocks, body_parts)
   end
-
-  -- Content blocks
-  local content_parts = process_blocks(doc.blocks, 0)
-  for _, p in ipairs(content_parts) do body_parts[#body_parts+1] = p end
+  process_blocks(doc.blocks, 0, body_parts)
 
   if #body_parts == 0 then
     body_parts[#body_parts+1] = make_paragraph_xml('')
@@ -1933,12 +2168,12 @@ function Pandoc(doc)
   local body_xml = table.concat(body_parts, '\n')
 
   -- Assemble XML files
-  local section_xml = build_section_xml(section0_raw, body_xml)
+  local section_xml = build_section_xml(section_prefix, body_xml)
   local header_xml = update_header_xml(header_xml_raw)
   local hpf_xml = update_content_hpf(hpf_xml_raw, title, author, date_str)
 
   -- Write HWPX
-  local success = write_hwpx(hwpx_path, section_xml, header_xml, hpf_xml)
+  local success = write_hwpx(hwpx_path, tmpdir, section_xml, header_xml, hpf_xml)
 
   if success then
     io.stderr:write('[hwpx] HWPX generation complete. Minimizing .docx output.\n')